@@ -5,9 +5,9 @@ import numpy as np
 import os
 from pathlib import Path
 import logging
-import glob
+import time
 
-import src.diff_eq_generator, src.diff_eq_simulator, src.diff_eq_recreator, src.plot_tools, src.utils
+import src.diff_eq_generator, src.diff_eq_simulator, src.diff_eq_recreator, src.diff_eq_refiner, src.experiment_design, src.plot_tools, src.utils
 
 
 # constants
@@ -15,9 +15,11 @@ SUBPARSER_KEY = "subparser"
 GENERATE_NAME = "generate"
 SIMULATE_NAME = "simulate"
 RECREATE_NAME = "recreate"
+PLOT_NAME = "plot"
 
-REACTANTS_SUFFIX = "_reactants"
-TIMES_SUFFIX = "_times"
+REACTANTS_SUFFIX = src.utils.REACTANTS_SUFFIX
+TIMES_SUFFIX = src.utils.TIMES_SUFFIX
+STOP_SUFFIX = src.utils.STOP_SUFFIX
 
 # logger
 logger = logging.getLogger(__name__)
@@ -41,7 +43,7 @@ def generate_runner(args: argparse.Namespace) -> None:
 
 
 def simulate_runner(args: argparse.Namespace) -> None:
-    if os.path.isdir(args.output_dir):
+    if os.path.isdir(args.output_dir) and not args.append:
         logger.warning("output directory with that name already exists")
         exit()
 
@@ -49,17 +51,49 @@ def simulate_runner(args: argparse.Namespace) -> None:
     with open(args.input_network_file, "rb") as in_file:
         rnet = pickle.load(in_file)
 
-    reactants_results, times_results = src.diff_eq_recreator.rand_runner(
+    stop_criteria = src.diff_eq_simulator.StopCriteria(
+        steady_state_tol=args.steady_state_tol,
+        divergence_bound=args.divergence_bound,
+        stop_on_negative=args.stop_on_negative,
+    )
+
+    residual_points, residuals = None, None
+    if args.residuals_file is not None:
+        with np.load(args.residuals_file) as residuals_data:
+            residual_points = residuals_data["points"]
+            residuals = residuals_data["residuals"]
+    elif args.design == src.experiment_design.DESIGN_ADAPTIVE:
+        logger.warning("the adaptive design needs --residuals_file")
+        exit()
+
+    reactants_results, times_results, stop_results = src.diff_eq_recreator.rand_runner(
         rnet=rnet,
         ubound=np.array([args.ubound] * len(rnet.species)),
         steps=args.steps,
         noise_intensity=np.array([args.noise_intensity] * len(rnet.species)),
         run_duration=args.run_duration,
         runs=args.runs,
+        dtype=src.utils.precision_dtype(args.precision),
+        stop_criteria=stop_criteria,
+        design=args.design,
+        residual_points=residual_points,
+        residuals=residuals,
     )
 
-    os.mkdir(args.output_dir)
-    for idx, (reactants, times) in enumerate(zip(reactants_results, times_results)):
+    # appended runs continue the numbering of the runs already saved
+    first_idx = 0
+    if os.path.isdir(args.output_dir):
+        existing_idxs = [
+            int(run_id)
+            for run_id in src.utils.list_simulation_runs(args.output_dir)
+            if run_id.isdigit()
+        ]
+        first_idx = max(existing_idxs, default=-1) + 1
+    else:
+        os.mkdir(args.output_dir)
+
+    for idx, (reactants, times, stop_reason) in enumerate(
+            zip(reactants_results, times_results, stop_results), start=first_idx):
         reactants_path = Path(Path(args.output_dir), Path(f"{idx}{REACTANTS_SUFFIX}"))
         np.save(
             reactants_path,
@@ -72,6 +106,31 @@ def simulate_runner(args: argparse.Namespace) -> None:
             times,
         )
         logger.info(f"saved {times_path}")
+        stop_path = Path(Path(args.output_dir), Path(f"{idx}{STOP_SUFFIX}"))
+        np.save(
+            stop_path,
+            np.array(stop_reason),
+        )
+        logger.info(f"saved {stop_path} ({stop_reason} after {len(times)} steps)")
+
+    # checked once the runs are saved, so a failed check never loses them
+    if args.precision != 64:
+        error = src.diff_eq_recreator.derivative_precision_error(
+            rnet,
+            src.utils.precision_dtype(args.precision),
+            ubound=np.array([args.ubound] * len(rnet.species)),
+            steps=args.steps,
+            noise_intensity=np.array([args.noise_intensity] * len(rnet.species)),
+            run_duration=args.run_duration,
+            stop_criteria=stop_criteria,
+            design=args.design,
+            residual_points=residual_points,
+            residuals=residuals,
+        )
+        logger.info(
+            f"float{args.precision} derivative targets differ from float64 by "
+            f"{error:.3g} (relative to the largest derivative)"
+        )
 
 
 def recreate_runner(args: argparse.Namespace) -> None:
@@ -79,44 +138,134 @@ def recreate_runner(args: argparse.Namespace) -> None:
         logger.warning("output directory with that name already exists")
         exit()
 
-    reactants_filenames = glob.glob(
-        f"*{REACTANTS_SUFFIX}*",
-        dir_fd=args.input_sim_dir,
-    )
-    reactants_filenames.sort()
-
-    times_filenames = glob.glob(
-        f"*{TIMES_SUFFIX}*",
-        dir_fd=args.input_sim_dir,
-    )
-    times_filenames.sort()
-
-    logger.debug(f"{reactants_filenames}")
-    logger.debug(f"{times_filenames}")
-
-    reactants_arrays = []
-    times_arrays = []
-
-    for reactants_filename, times_filename in zip(reactants_filenames, times_filenames):
-        reactants_path = Path(Path(args.input_sim_dir), Path(reactants_filename))
-        logger.debug(f"loading: {reactants_path}")
-        reactants_arrays.append(np.load(reactants_path))
-        times_path = Path(Path(args.input_sim_dir), Path(times_filename))
-        logger.debug(f"loading: {times_path}")
-        times_arrays.append(np.load(times_path))
-
-    merged_qty_data, _, merged_qty_drv = src.diff_eq_recreator.data_set_bundler(
-        reactants_arrays,
-        times_arrays,
-    )
-    model = src.diff_eq_recreator.regressor_fit(
-        merged_qty_data,
-        merged_qty_drv,
-        maxsize=args.maxsize,
-        niterations=args.niterations,
-    )
+    # runs kept for trajectory refinement, diverged runs would dominate its loss
+    refine_qty, refine_times = [], []
+    merged_qty_data, merged_qty_drv = None, None
+    model = None
+    seen_runs = set()
+    increment = 0
+    last_new_run = time.monotonic()
+
+    # in follow mode a run only counts once its stop file, written last, exists
+    require_stop = args.follow
+    if args.follow:
+        all_runs = src.utils.list_simulation_runs(args.input_sim_dir)
+        stopped_runs = src.utils.list_simulation_runs(args.input_sim_dir, require_stop=True)
+        if all_runs and not stopped_runs:
+            # saved before stop files were written, or by another tool
+            logger.warning(
+                f"no run in {args.input_sim_dir} has a stop file, "
+                "following runs without waiting for one"
+            )
+            require_stop = False
+        elif len(stopped_runs) < len(all_runs):
+            logger.warning(
+                f"skipping {len(all_runs) - len(stopped_runs)} runs until "
+                "their stop file is written"
+            )
+
+    while True:
+        new_runs = [
+            run_id
+            for run_id in src.utils.list_simulation_runs(
+                args.input_sim_dir,
+                require_stop=require_stop,
+            )
+            if run_id not in seen_runs
+        ]
+        seen_runs.update(new_runs)
+
+        reactants_arrays, times_arrays, stop_reasons = src.utils.load_simulation_runs(
+            args.input_sim_dir,
+            new_runs,
+        )
+        kept_runs = [
+            reason != src.diff_eq_simulator.STOP_DIVERGED for reason in stop_reasons
+        ]
+
+        if any(kept_runs):
+            last_new_run = time.monotonic()
+            increment += 1
+            logger.info(f"increment {increment}: {len(new_runs)} new runs")
+            for qty, times, kept in zip(reactants_arrays, times_arrays, kept_runs):
+                if kept:
+                    refine_qty.append(qty)
+                    refine_times.append(times)
+
+            # only the new runs are bundled, then appended to the dataset
+            new_qty_data, _, new_qty_drv = src.diff_eq_recreator.data_set_bundler(
+                reactants_arrays,
+                times_arrays,
+                dtype=src.utils.precision_dtype(args.precision),
+                stop_reasons=stop_reasons,
+            )
+            if merged_qty_data is None:
+                merged_qty_data, merged_qty_drv = new_qty_data, new_qty_drv
+            else:
+                merged_qty_data = np.concat([merged_qty_data, new_qty_data], axis=0)
+                merged_qty_drv = np.concat([merged_qty_drv, new_qty_drv], axis=0)
+
+            niterations = args.niterations
+            if model is not None and args.increment_niterations is not None:
+                niterations = args.increment_niterations
+
+            model, fit_stop_reason = src.diff_eq_recreator.regressor_fit(
+                merged_qty_data,
+                merged_qty_drv,
+                maxsize=args.maxsize,
+                niterations=niterations,
+                precision=args.precision,
+                time_budget=args.time_budget,
+                loss_target=args.loss_target,
+                plateau_iterations=args.plateau_iterations,
+                model=model,
+            )
+
+            write_recreate_results(
+                args,
+                model,
+                fit_stop_reason,
+                merged_qty_data,
+                merged_qty_drv,
+                refine_qty,
+                refine_times,
+                header=f"increment {increment}: {len(refine_qty)} runs, "
+                       f"{merged_qty_data.shape[0]} rows\n" if args.follow else None,
+            )
+        elif model is None and not args.follow:
+            logger.warning("no usable simulation runs found")
+
+        if not args.follow:
+            break
+        if (args.idle_timeout is not None
+                and time.monotonic() - last_new_run > args.idle_timeout):
+            logger.info(f"no new runs for {args.idle_timeout}s, stopping")
+            break
+        time.sleep(args.poll_interval)
+
+
+def write_recreate_results(args: argparse.Namespace,
+                           model: "pysr.PySRRegressor",
+                           fit_stop_reason: str,
+                           merged_qty_data: np.ndarray,
+                           merged_qty_drv: np.ndarray,
+                           refine_qty: list[np.ndarray],
+                           refine_times: list[np.ndarray],
+                           header: str | None = None) -> None:
+    if args.residuals_file is not None:
+        np.savez(
+            args.residuals_file,
+            points=merged_qty_data,
+            residuals=src.diff_eq_recreator.fit_residuals(
+                model,
+                merged_qty_data,
+                merged_qty_drv,
+            ),
+        )
+        logger.info(f"saved {args.residuals_file}")
 
-    output_buf = []
+    output_buf = [] if header is None else [header]
+    output_buf.append(f"fit stopped by: {fit_stop_reason}\n")
     for eq in model.equations_:
         output_buf.append(eq[["complexity", "loss", "score", "equation", "sympy_format"]].to_string())
         output_buf.append("\n")
@@ -125,16 +274,75 @@ def recreate_runner(args: argparse.Namespace) -> None:
         output_buf.append(best.to_string())
         output_buf.append("\n")
 
-    output_msg = "\n".join(output_buf)
+    # write the fit before refining, so a failed refinement never loses it
+    emit_output(args.output, "\n".join(output_buf))
+    if args.refine_top <= 0:
+        return
+
+    # windows cannot be longer than the longest stored run
+    segment_steps = min(
+        args.refine_segment_steps,
+        max((qty.shape[0] for qty in refine_qty), default=0) - 1,
+    )
+    if segment_steps < 1:
+        logger.warning("skipped refinement: no run has more than one step")
+        return
+    if segment_steps < args.refine_segment_steps:
+        logger.warning(
+            f"runs are too short for --refine_segment_steps {args.refine_segment_steps}, "
+            f"using {segment_steps}"
+        )
+    try:
+        refined_systems = src.diff_eq_refiner.refine_hall_of_fame(
+            model,
+            refine_qty,
+            refine_times,
+            top_n=args.refine_top,
+            segment_steps=segment_steps,
+        )
+    except ValueError as err:
+        logger.warning(f"skipped refinement: {err}")
+        return
+
+    output_buf = [""]
+    for refined in refined_systems:
+        output_buf.append(
+            f"refined loss: {refined.loss:.6g} (before: {refined.initial_loss:.6g})"
+        )
+        for idx, eq in enumerate(refined.equations):
+            output_buf.append(f"  dx{idx}/dt = {eq}")
+        output_buf.append("\n")
+    emit_output(args.output, "\n".join(output_buf), append=True)
 
-    if args.output is not None:
-        with open(args.output, "w") as out_file:
+
+def emit_output(output: str | None, output_msg: str, append: bool = False) -> None:
+    if output is not None:
+        with open(output, "a" if append else "w") as out_file:
             out_file.write(output_msg)
 
     else:
         print(output_msg)
 
 
+def plot_runner(args: argparse.Namespace) -> None:
+    if not os.path.isdir(args.input_sim_dir):
+        logger.warning("simulation directory with that name does not exist")
+        exit()
+    if args.max_points < src.plot_tools.PHASE_PORTRAIT_MIN_POINTS:
+        logger.warning(
+            f"--max_points must be at least {src.plot_tools.PHASE_PORTRAIT_MIN_POINTS}"
+        )
+        exit()
+
+    src.plot_tools.plot_simulation_dir(
+        args.input_sim_dir,
+        output_file=args.output_file,
+        max_points=args.max_points,
+        method=args.method,
+    )
+    logger.info(f"saved {args.output_file}")
+
+
 def parse_cl_args():
     parser = argparse.ArgumentParser(
         prog="python main.py",
@@ -233,6 +441,48 @@ def parse_cl_args():
         type=str,
         required=True,
     )
+    simulate_subparser.add_argument(
+        "--append",
+        help="Add the runs to an existing output directory",
+        action="store_true",
+    )
+    simulate_subparser.add_argument(
+        "--precision",
+        help="Floating point precision (bits) of the simulation and saved data",
+        type=int,
+        choices=list(src.utils.PRECISION_DTYPES),
+        default=64,
+    )
+    simulate_subparser.add_argument(
+        "--steady_state_tol",
+        help="Stop a run once max |dx/dt| falls below this tolerance",
+        type=float,
+        default=None,
+    )
+    simulate_subparser.add_argument(
+        "--divergence_bound",
+        help="Stop a run once a quantity's magnitude exceeds this bound (inf/NaN always stops a run)",
+        type=float,
+        default=None,
+    )
+    simulate_subparser.add_argument(
+        "--stop_on_negative",
+        help="Stop a run once a quantity becomes negative",
+        action="store_true",
+    )
+    simulate_subparser.add_argument(
+        "--design",
+        help="How the randomized initial conditions are placed",
+        type=str,
+        choices=src.experiment_design.DESIGNS,
+        default=src.experiment_design.DESIGN_RANDOM,
+    )
+    simulate_subparser.add_argument(
+        "--residuals_file",
+        help="Fit residuals saved by recreate, used by the adaptive design",
+        type=str,
+        default=None,
+    )
 
     # Aim 3: Use the time series data to try and recreate the original differential equation
     recreate_subparser = subparsers.add_parser(
@@ -263,6 +513,104 @@ def parse_cl_args():
         type=str,
         default=None,
     )
+    recreate_subparser.add_argument(
+        "--precision",
+        help="Floating point precision (bits) of the bundled data and the fit",
+        type=int,
+        choices=list(src.utils.PRECISION_DTYPES),
+        default=64,
+    )
+    recreate_subparser.add_argument(
+        "--residuals_file",
+        help="Save the fit residuals here (.npz) for the adaptive simulate design",
+        type=str,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--time_budget",
+        help="Wall time limit of the fit, in seconds. Applies to each refit in follow mode",
+        type=float,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--loss_target",
+        help="Stop the fit once the best loss of every species reaches this value",
+        type=float,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--plateau_iterations",
+        help="Stop the fit once the best loss has not improved for this many iterations",
+        type=int,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--follow",
+        help="Keep watching the simulation directory and refit, warm started, as new runs arrive",
+        action="store_true",
+    )
+    recreate_subparser.add_argument(
+        "--poll_interval",
+        help="Seconds between checks for new runs in follow mode",
+        type=float,
+        default=60,
+    )
+    recreate_subparser.add_argument(
+        "--idle_timeout",
+        help="Stop following once no new runs have arrived for this many seconds",
+        type=float,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--increment_niterations",
+        help="Fitting iterations for each warm started refit in follow mode. Defaults to --niterations",
+        type=int,
+        default=None,
+    )
+    recreate_subparser.add_argument(
+        "--refine_top",
+        help="Refine the constants of the top N hall of fame equations per species against whole trajectories. 0 disables refinement",
+        type=int,
+        default=0,
+    )
+    recreate_subparser.add_argument(
+        "--refine_segment_steps",
+        help="Number of steps per multiple shooting window used for refinement",
+        type=int,
+        default=20,
+    )
+
+    # Plot the simulated time series data
+    plot_subparser = subparsers.add_parser(
+        name=PLOT_NAME,
+        help="Plot the trajectories of a saved simulation",
+    )
+    plot_subparser.add_argument(
+        "--input_sim_dir",
+        help="Directory name of the saved simulation",
+        type=str,
+        required=True,
+    )
+    plot_subparser.add_argument(
+        "--output_file",
+        help="Filename to save the figure to",
+        type=str,
+        required=True,
+    )
+    plot_subparser.add_argument(
+        "--max_points",
+        help="Maximum number of points drawn per run and species, at least "
+             f"{src.plot_tools.PHASE_PORTRAIT_MIN_POINTS}",
+        type=int,
+        default=1000,
+    )
+    plot_subparser.add_argument(
+        "--method",
+        help="Downsampling method for long runs",
+        type=str,
+        choices=[src.plot_tools.DOWNSAMPLE_MINMAX, src.plot_tools.DOWNSAMPLE_LTTB],
+        default=src.plot_tools.DOWNSAMPLE_MINMAX,
+    )
 
     logger.debug(f"{parser.parse_args()=}")
     return parser
@@ -289,3 +637,5 @@ if __name__ == "__main__":
         # print(RECREATE_NAME)
         # Call methods from diff_eq_recreator
         recreate_runner(args)
+    elif use_subparser == PLOT_NAME:
+        plot_runner(args)
@@ -6,9 +6,11 @@ Created on Tue Apr 29 10:43:50 2025
 """
 
 from dataclasses import dataclass, field
+from typing import Callable
 
 import sympy as sp
 import numpy as np
+import scipy.sparse
 
 
 
@@ -115,6 +117,243 @@ def create_callables(species: list[sp.core.symbol.Symbol], odes: list) -> list:
     return x_eqs
 
 
+@dataclass
+class CompiledJacobian:
+    """
+    rows (np.ndarray): Row index of each structurally nonzero entry.
+    cols (np.ndarray): Column index of each structurally nonzero entry.
+    shape (tuple): Shape of the full matrix.
+    values (callable): Takes X, shaped [..., species], and returns the
+        nonzero entries, shaped [..., len(rows)].
+    """
+    rows: np.ndarray
+    cols: np.ndarray
+    shape: tuple[int, int]
+    values: Callable[[np.ndarray], np.ndarray]
+
+    def sparsity(self) -> scipy.sparse.csr_array:
+        """
+        Sparsity pattern, e.g. for the jac_sparsity argument of stiff solvers.
+        """
+        return scipy.sparse.csr_array(
+            (np.ones(len(self.rows)), (self.rows, self.cols)),
+            shape=self.shape,
+        )
+
+    def __call__(self, X: np.ndarray, sparse: bool = False
+                 ) -> np.ndarray | scipy.sparse.csr_array:
+        """
+        Evaluate the matrix at X.
+
+        Args:
+            X: Reactant quantities, 1d or batched as [..., species]
+            sparse: Return a scipy sparse array, only for 1d X
+        Returns:
+            matrix: Dense array [..., rows, cols], or sparse array
+        """
+        X = np.asarray(X, dtype=float)
+        data = self.values(X)
+        if sparse:
+            if X.ndim != 1:
+                raise ValueError("sparse output needs a single state")
+            return scipy.sparse.csr_array(
+                (data, (self.rows, self.cols)), shape=self.shape,
+            )
+        matrix = np.zeros(X.shape[:-1] + self.shape, dtype=data.dtype)
+        matrix[..., self.rows, self.cols] = data
+        return matrix
+
+
+def stoichiometry(rnet: ReactionNetwork) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collect the mass-action description of a ReactionNetwork as arrays.
+
+    Args:
+        rnet: The reaction network
+
+    Returns:
+        orders: 2d array [reaction, species] of reactant stoichiometry, which
+                is the order of the rate law in each species
+        net: 2d array [species, reaction] of the net change of each species
+             per unit of reaction
+        rates: 1d array of the rate constants
+    """
+    index = {str(spec): idx for idx, spec in enumerate(rnet.species)}
+    orders = np.zeros((len(rnet.reactions), len(rnet.species)))
+    net = np.zeros((len(rnet.species), len(rnet.reactions)))
+    rates = np.zeros(len(rnet.reactions))
+
+    for rxn_idx, rxn in enumerate(rnet.reactions):
+        for name, stoich in rxn['reactants'].items():
+            orders[rxn_idx, index[name]] += stoich
+            net[index[name], rxn_idx] -= stoich
+        for name, stoich in rxn['products'].items():
+            net[index[name], rxn_idx] += stoich
+        rates[rxn_idx] = rxn['rate_constant']
+
+    return orders, net, rates
+
+
+def _combine_entries(net: np.ndarray, entry_rxns: np.ndarray,
+                     entry_cols: np.ndarray, num_cols: int
+                     ) -> tuple[np.ndarray, np.ndarray, scipy.sparse.csr_array]:
+    """
+    Find the nonzero entries of net @ D, where D[reaction, col] is nonzero at
+    (entry_rxns, entry_cols), and the sparse map from D's entries to them.
+    """
+    species_idx, entry_idx = np.nonzero(net[:, entry_rxns])
+    flat = species_idx * num_cols + entry_cols[entry_idx]
+    keys, position = np.unique(flat, return_inverse=True)
+    combine = scipy.sparse.csr_array(
+        (net[species_idx, entry_rxns[entry_idx]], (position, entry_idx)),
+        shape=(len(keys), len(entry_rxns)),
+    )
+    rows, cols = np.divmod(keys, num_cols)
+    return rows, cols, combine
+
+
+def _apply(combine: scipy.sparse.csr_array, entries: np.ndarray) -> np.ndarray:
+    """
+    Apply a sparse map to the last axis of a (possibly batched) array.
+    """
+    batch = entries.shape[:-1]
+    # an explicit batch size, as -1 is ambiguous when there are no entries
+    flat = entries.reshape(int(np.prod(batch)), entries.shape[-1])
+    return (combine @ flat.T).T.reshape(batch + (combine.shape[0],))
+
+
+def _monomials(exponents: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Compile prod_j x_j**exponents[m, j] for every row m, multiplying only the
+    factors with a nonzero exponent.
+    """
+    entry_idx, species_idx = np.nonzero(exponents)
+    powers = exponents[entry_idx, species_idx]
+    raised = powers != 1
+    # factors come grouped by row; rows without any give an empty product
+    has_factors, starts = np.unique(entry_idx, return_index=True)
+    num_entries = exponents.shape[0]
+
+    def monomials(X: np.ndarray) -> np.ndarray:
+        factors = X[..., species_idx]
+        factors[..., raised] **= powers[raised]
+        products = np.ones(X.shape[:-1] + (num_entries,), dtype=factors.dtype)
+        if len(starts):
+            products[..., has_factors] = np.multiply.reduceat(factors, starts, axis=-1)
+        return products
+
+    return monomials
+
+
+def create_jacobian(rnet: ReactionNetwork) -> CompiledJacobian:
+    """
+    Compile the Jacobian d[dx_i/dt]/dx_j of a ReactionNetwork from the closed
+    mass-action form of its reactions. Each reaction contributes
+    net_ir * k_r * a_jr * x_j**(a_jr - 1) * prod_{l != j} x_l**a_lr.
+
+    Args:
+        rnet: The reaction network
+
+    Returns:
+        jacobian: Callable returning the Jacobian at a state, with its
+                  sparsity pattern
+    """
+    orders, net, rates = stoichiometry(rnet)
+    num_species = len(rnet.species)
+
+    # one entry per (reaction, reactant) pair: the rate law's partial derivative
+    entry_rxns, entry_cols = np.nonzero(orders)
+    coefficients = rates[entry_rxns] * orders[entry_rxns, entry_cols]
+    exponents = orders[entry_rxns].copy()
+    exponents[np.arange(len(entry_rxns)), entry_cols] -= 1
+
+    rows, cols, combine = _combine_entries(net, entry_rxns, entry_cols, num_species)
+    monomials = _monomials(exponents)
+
+    def values(X: np.ndarray) -> np.ndarray:
+        return _apply(combine, coefficients * monomials(X))
+
+    return CompiledJacobian(
+        rows=rows,
+        cols=cols,
+        shape=(num_species, num_species),
+        values=values,
+    )
+
+
+def create_rate_sensitivity(rnet: ReactionNetwork) -> CompiledJacobian:
+    """
+    Compile the sensitivity d[dx_i/dt]/dk_r of a ReactionNetwork to its rate
+    constants, net_ir * prod_l x_l**a_lr.
+
+    Args:
+        rnet: The reaction network
+
+    Returns:
+        sensitivity: Callable returning the [species, reaction] sensitivity
+                     at a state, with its sparsity pattern
+    """
+    orders, net, _ = stoichiometry(rnet)
+    num_species, num_reactions = net.shape
+
+    entry_rxns = np.arange(num_reactions)
+    rows, cols, combine = _combine_entries(net, entry_rxns, entry_rxns, num_reactions)
+    unit_rates = _monomials(orders)
+
+    def values(X: np.ndarray) -> np.ndarray:
+        return _apply(combine, unit_rates(X))
+
+    return CompiledJacobian(
+        rows=rows,
+        cols=cols,
+        shape=(num_species, num_reactions),
+        values=values,
+    )
+
+
+def create_symbolic_jacobian(species: list[sp.core.symbol.Symbol],
+                             odes: list) -> CompiledJacobian:
+    """
+    Compile the Jacobian of any set of odes by symbolic differentiation. Use
+    create_jacobian for mass-action ReactionNetworks, which scales better.
+
+    Args:
+        species: List of sympy symbols representing each species' quantity
+        odes: list of ordinary differential equation represented by sympy functions
+
+    Returns:
+        jacobian: Callable returning the Jacobian at a state, with its
+                  sparsity pattern
+    """
+    matrix = sp.Matrix([sp.sympify(ode) for ode in odes]).jacobian(list(species))
+    rows, cols = [], []
+    entries = []
+    for (row, col), entry in np.ndenumerate(np.array(matrix.tolist(), dtype=object)):
+        if entry != 0:
+            rows.append(row)
+            cols.append(col)
+            entries.append(entry)
+
+    lam = sp.lambdify(list(species), entries, modules="numpy")
+
+    def values(X: np.ndarray) -> np.ndarray:
+        if not entries:
+            return np.zeros(X.shape[:-1] + (0,))
+        results = lam(*np.moveaxis(X, -1, 0))
+        # constant entries come back as scalars
+        return np.stack(
+            [np.broadcast_to(result, X.shape[:-1]) for result in results],
+            axis=-1,
+        ).astype(float)
+
+    return CompiledJacobian(
+        rows=np.array(rows, dtype=int),
+        cols=np.array(cols, dtype=int),
+        shape=matrix.shape,
+        values=values,
+    )
+
+
 if __name__ == "__main__":
     # Example usage:
     rnet = generate_reaction_network(num_species=3, num_reactions=4, seed=42)
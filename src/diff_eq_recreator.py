@@ -3,11 +3,27 @@ diff_eq_recreator.py
 
 Tools for recreating the differential equation from the time series data
 """
+import logging
+import time
+
 import numpy as np
 import pysr
 
-from src.diff_eq_simulator import (simulate_network)
-from .utils import derivative_finder_diff
+from src.diff_eq_simulator import (simulate_network, StopCriteria,
+    STOP_DIVERGED)
+from .experiment_design import initial_conditions, DESIGN_RANDOM
+from .utils import derivative_finder_diff, precision_error
+
+
+# reasons a regressor fit stopped
+FIT_COMPLETED = "niterations"
+FIT_TIME_BUDGET = "time_budget"
+FIT_LOSS_TARGET = "loss_target"
+FIT_PLATEAU = "plateau"
+
+# logger
+logger = logging.getLogger(__name__)
+
 
 def example_function():
     print(f"the example function in {__file__} is running")
@@ -17,7 +33,13 @@ def rand_runner(rnet: ".diff_eq_generator.ReactionNetwork",
                 ubound: np.ndarray|None = None, steps: int = 50,
                 noise_intensity: np.ndarray|None = None,
                 run_duration: int = 1,
-                runs: int = 3) -> tuple[list[np.ndarray], list[np.ndarray]]:
+                runs: int = 3,
+                dtype: type = np.float64,
+                stop_criteria: StopCriteria | None = None,
+                design: str = DESIGN_RANDOM,
+                residual_points: np.ndarray | None = None,
+                residuals: np.ndarray | None = None,
+                ) -> tuple[list[np.ndarray], list[np.ndarray], list[str]]:
     """
     Take in a ReactionNetwork and run a set of randomized, simulated runs.
 
@@ -26,13 +48,23 @@ def rand_runner(rnet: ".diff_eq_generator.ReactionNetwork",
         ubound: Initial values for the reactants will be randomly selected
                 between 0 and the values provided here
         runs: Number of independent simulations to execute
+        dtype: Floating point type of the simulated arrays
+        stop_criteria: Conditions that end each run early. Stopped runs are
+                       truncated.
+        design: How initial conditions are placed in the ubound box, one of
+                experiment_design.DESIGNS
+        residual_points: Reactant quantities of an earlier fit, used by the
+                         adaptive design
+        residuals: Residual magnitude of the earlier fit at residual_points
     Returns:
         reactants_data: a list of the reactant quantites over time for each sim 
         times_data: a list of the timestamps for each sim
+        stop_reasons: a list of the STOP_* constant each run stopped with
 
     """
     reactants_data = []
     times_data = [] 
+    stop_reasons = []
 
     _noise_intensity = np.zeros(len(rnet.species))
     if noise_intensity is not None:
@@ -42,21 +74,44 @@ def rand_runner(rnet: ".diff_eq_generator.ReactionNetwork",
     if ubound is not None:
         _ubound = ubound
 
-    for _ in range(runs):
-        reactants, times = simulate_network(
+    x0s = None
+    if design != DESIGN_RANDOM:
+        # seed from the global generator so np.random.seed stays effective
+        x0s = initial_conditions(
+            runs,
+            _ubound,
+            design=design,
+            rng=np.random.default_rng(np.random.randint(0, 2**31)),
+            residual_points=residual_points,
+            residuals=residuals,
+        )
+
+    for run in range(runs):
+        if x0s is None:
+            x0 = _ubound * np.random.random(_ubound.shape)
+        else:
+            x0 = x0s[run]
+        reactants, times, stop_reason = simulate_network(
             rnet,
-            x0=_ubound * np.random.random(_ubound.shape),
+            x0=x0,
             t0=0,
             tf=run_duration,
             num_steps=steps,
             noise_intensity=_noise_intensity,
+            dtype=dtype,
+            stop_criteria=stop_criteria,
         )
         reactants_data.append(reactants)
         times_data.append(times)
+        stop_reasons.append(stop_reason)
 
-    return reactants_data, times_data
+    return reactants_data, times_data, stop_reasons
 
-def data_set_bundler(qty_data: list[np.ndarray], times_data: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+def data_set_bundler(qty_data: list[np.ndarray], times_data: list[np.ndarray],
+                     dtype: type | None = None,
+                     stop_reasons: list[str] | None = None,
+                     drop_reasons: tuple[str, ...] = (STOP_DIVERGED,),
+                     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Take the output of rand_runner, calculate the derivatives and reformat the
     data to feed directly into pysr's fit method.
@@ -64,64 +119,239 @@ def data_set_bundler(qty_data: list[np.ndarray], times_data: list[np.ndarray]) -
     Args:
         qty_data: A collections of runs over the same network
         times_data: The time stamps associated with each simulated run
+        dtype: Floating point type of the bundled arrays. Defaults to the
+               type of the input data. Derivatives are always found in
+               float64 and only the result is cast.
+        stop_reasons: The reason each run stopped, as returned by rand_runner
+        drop_reasons: Runs that stopped for any of these reasons are left out
 
     Returns:
         merged_qty_data: A 2d array of reactant quantites, appended in time
         merged_times_data: A 1d array of timestamps
         merged_qty_drv: A 2d array of the derivative of the reactant quantities.
     """
+    if stop_reasons is not None:
+        keep = [reason not in drop_reasons for reason in stop_reasons]
+        qty_data = [qty for qty, k in zip(qty_data, keep) if k]
+        times_data = [times for times, k in zip(times_data, keep) if k]
+
     qty_drv = []
     for qty, times in zip(qty_data, times_data):
-        qty_drv.append(
-            derivative_finder_diff(qty, times)
+        drv = derivative_finder_diff(
+            qty.astype(np.float64, copy=False),
+            times.astype(np.float64, copy=False),
         )
+        if dtype is None:
+            drv = drv.astype(qty.dtype, copy=False)
+        qty_drv.append(drv)
 
     merged_qty_data = np.concat([qty[:-1,:] for qty in qty_data], axis=0)
     merged_times_data = np.concat([times[:-1] for times in times_data], axis=0)
     merged_qty_drv = np.concat(qty_drv, axis=0)
 
+    if dtype is not None:
+        merged_qty_data = merged_qty_data.astype(dtype, copy=False)
+        merged_times_data = merged_times_data.astype(dtype, copy=False)
+        merged_qty_drv = merged_qty_drv.astype(dtype, copy=False)
+
     return (
         merged_qty_data,
         merged_times_data,
         merged_qty_drv,
     )
 
+def derivative_precision_error(rnet: ".diff_eq_generator.ReactionNetwork",
+                               dtype: type, **kwargs) -> float:
+    """
+    Simulate one run at float64 and at dtype from the same random state and
+    compare the derivative targets handed to pysr. A reduced precision run can
+    stop earlier, e.g. by overflowing, so only the steps both runs reached are
+    compared.
+
+    Args:
+        rnet: The ReactionNetwork to be simulated
+        dtype: The reduced floating point type
+        kwargs: passed through to rand_runner
+    Returns:
+        error: precision_error of the reduced precision derivative targets,
+               NaN if the runs share fewer than two steps
+    """
+    state = np.random.get_state()
+    qty_ref, times_ref, reasons_ref = rand_runner(rnet, runs=1, dtype=np.float64, **kwargs)
+    np.random.set_state(state)
+    qty, times, reasons = rand_runner(rnet, runs=1, dtype=dtype, **kwargs)
+
+    shared_steps = min(qty_ref[0].shape[0], qty[0].shape[0])
+    if reasons_ref != reasons or qty_ref[0].shape[0] != qty[0].shape[0]:
+        logger.warning(
+            f"the float64 run stopped by {reasons_ref[0]} after "
+            f"{qty_ref[0].shape[0]} steps and the {np.dtype(dtype)} run by "
+            f"{reasons[0]} after {qty[0].shape[0]} steps, comparing the first "
+            f"{shared_steps}"
+        )
+    if shared_steps < 2:
+        return float("nan")
+
+    _, _, drv_ref = data_set_bundler(
+        [qty_ref[0][:shared_steps]], [times_ref[0][:shared_steps]])
+    _, _, drv = data_set_bundler(
+        [qty[0][:shared_steps]], [times[0][:shared_steps]], dtype=dtype)
+    return precision_error(drv_ref, drv)
+
+
+def best_losses(model: "pysr.PySRRegressor") -> np.ndarray:
+    """
+    Lowest hall of fame loss of a fitted model, for each target.
+
+    Args:
+        model : fitted regressor model
+
+    Returns:
+        losses : 1d array of the best loss of every target
+    """
+    equations = model.equations_
+    if not isinstance(equations, list):
+        equations = [equations]
+    return np.array([float(eqs["loss"].min()) for eqs in equations])
+
+
 def regressor_fit(dataset: np.ndarray, target: np.ndarray, maxsize: int = 20,
-                  niterations: int = 40, verbosity: int = 0
-                  ) -> "pysr.PySRRegressor":
+                  niterations: int = 40, verbosity: int = 0,
+                  precision: int = 64,
+                  time_budget: float | None = None,
+                  loss_target: float | None = None,
+                  plateau_iterations: int | None = None,
+                  plateau_rtol: float = 1e-3,
+                  check_every: int = 10,
+                  model: "pysr.PySRRegressor | None" = None,
+                  ) -> "tuple[pysr.PySRRegressor, str]":
     """
     Use pysr to fit the dataset and target.
 
+    The time budget and loss target are handed to pysr as timeout_in_seconds
+    and early_stop_condition. When a plateau is requested the search is run in
+    warm started chunks of check_every iterations and stopped once the best
+    loss stops improving.
+
     Args:
         dataset : 2d array with the reactant qty. time [t,q]
         target : 1d array containing the desired values, matched in t
+        precision : Floating point precision (32 or 64) used by the search
+        time_budget : Wall time limit of the whole fit, in seconds
+        loss_target : Stop once the best loss of every target is at or below
+                      this
+        plateau_iterations : Stop once the best loss of no target has improved
+                             for this many iterations
+        plateau_rtol : Relative decrease of a target's best loss that counts
+                       as an improvement
+        check_every : Iterations per chunk when watching for a plateau
+        model : A previously fitted model. The search is warm started from its
+                hall of fame and populations instead of starting cold.
 
     Returns:
         mode : fitted regressor model containing results
+        stop_reason : One of the FIT_* constants, the criterion that stopped
+                      the fit
     """
-    model = pysr.PySRRegressor(
-        maxsize=maxsize,
-        # populations=4,
-        niterations=niterations,  # < Increase me for better results
-        binary_operators=["+", "*"],
-        # unary_operators=[
-        #     "cos",
-        #     "exp",
-        #     "sin",
-        #     "inv(x) = 1/x",
-        #     # ^ Custom operator (julia syntax)
-        # ],
-        # extra_sympy_mappings={"inv": lambda x: 1 / x},
-        # ^ Define operator for SymPy as well
-        elementwise_loss="loss(prediction, target) = (prediction - target)^2",
-        # ^ Custom loss function (julia syntax)
-        # warm_start=True,
-        annealing=True,
-        verbosity=verbosity,
-    )
-    model.fit(
-        dataset,
-        target,
+    start_time = time.monotonic()
+    chunked = plateau_iterations is not None
+
+    first_niterations = min(check_every, niterations) if chunked else niterations
+    if model is not None:
+        # continue the previous search on the (possibly grown) dataset
+        model.set_params(
+            niterations=first_niterations,
+            warm_start=True,
+            timeout_in_seconds=time_budget,
+            early_stop_condition=loss_target,
+        )
+    else:
+        model = pysr.PySRRegressor(
+            maxsize=maxsize,
+            # populations=4,
+            niterations=first_niterations,  # < Increase me for better results
+            binary_operators=["+", "*"],
+            # unary_operators=[
+            #     "cos",
+            #     "exp",
+            #     "sin",
+            #     "inv(x) = 1/x",
+            #     # ^ Custom operator (julia syntax)
+            # ],
+            # extra_sympy_mappings={"inv": lambda x: 1 / x},
+            # ^ Define operator for SymPy as well
+            elementwise_loss="loss(prediction, target) = (prediction - target)^2",
+            # ^ Custom loss function (julia syntax)
+            warm_start=chunked,
+            annealing=True,
+            verbosity=verbosity,
+            precision=precision,
+            timeout_in_seconds=time_budget,
+            early_stop_condition=loss_target,
+        )
+
+    stop_reason = None
+    done_iterations = 0
+    since_improvement = 0
+    prev_losses = np.inf
+    while stop_reason is None:
+        model.fit(
+            dataset,
+            target,
+        )
+        done_iterations += model.niterations
+        losses = best_losses(model)
+        # every target has to meet the loss target
+        loss = float(np.max(losses))
+        elapsed = time.monotonic() - start_time
+        logger.debug(f"{done_iterations=} {loss=} {elapsed=}")
+
+        if loss_target is not None and loss <= loss_target:
+            stop_reason = FIT_LOSS_TARGET
+        elif time_budget is not None and elapsed >= time_budget:
+            stop_reason = FIT_TIME_BUDGET
+        elif not chunked or done_iterations >= niterations:
+            stop_reason = FIT_COMPLETED
+        else:
+            # any target still improving keeps the search going
+            improved = losses < prev_losses * (1 - plateau_rtol)
+            if np.any(improved):
+                since_improvement = 0
+                prev_losses = np.where(improved, losses, prev_losses)
+            else:
+                since_improvement += model.niterations
+            if since_improvement >= plateau_iterations:
+                stop_reason = FIT_PLATEAU
+            else:
+                # the next chunk continues the search with the time left
+                model.set_params(
+                    niterations=min(check_every, niterations - done_iterations),
+                )
+                if time_budget is not None:
+                    model.set_params(timeout_in_seconds=time_budget - elapsed)
+
+    logger.info(
+        f"fit stopped by {stop_reason}: best loss {loss:.6g} after "
+        f"{time.monotonic() - start_time:.0f}s"
     )
+    return model, stop_reason
+
+
+def fit_residuals(model: "pysr.PySRRegressor", dataset: np.ndarray,
+                  target: np.ndarray) -> np.ndarray:
+    """
+    Measure how far the fitted equations are from the target at each row.
 
-    return model
+    Args:
+        model : fitted regressor model
+        dataset : 2d array with the reactant qty. time [t,q]
+        target : array of the desired values, matched in t
+
+    Returns:
+        residuals : 1d array of the euclidean norm of the residual at each row
+    """
+    prediction = np.asarray(model.predict(dataset)).reshape(target.shape)
+    residual = prediction - target
+    if residual.ndim == 1:
+        return np.abs(residual)
+    return np.linalg.norm(residual, axis=1)
@@ -0,0 +1,270 @@
+"""
+diff_eq_refiner.py
+
+Refine the numeric constants of recovered differential equations against whole
+trajectories, using JAX for the gradients.
+"""
+from dataclasses import dataclass
+
+import jax
+import jax.numpy as jnp
+import jax.experimental
+import jax.scipy.optimize
+import numpy as np
+import sympy as sp
+
+# scoped 64-bit mode, moved out of jax.experimental in newer releases
+if hasattr(jax, "enable_x64"):
+    _enable_x64 = jax.enable_x64
+else:
+    _enable_x64 = jax.experimental.enable_x64
+
+
+def example_function():
+    print(f"the example function in {__file__} is running")
+
+
+@dataclass
+class RefinedSystem:
+    """
+    equations (list): sympy expressions for d[species]/dt with refined constants.
+    loss (float): Multiple shooting loss after refinement.
+    initial_loss (float): Multiple shooting loss before refinement.
+    """
+    equations: list
+    loss: float
+    initial_loss: float
+
+
+def parametrize_constants(exprs: list) -> tuple[list, list[sp.Symbol], np.ndarray]:
+    """
+    Swap every floating point constant in a set of expressions for a symbol.
+
+    Args:
+        exprs: sympy expressions
+    Returns:
+        param_exprs: The expressions written in terms of the new symbols
+        params: The new symbols, one per constant
+        values: 1d array of the constant values, matched with params
+    """
+    param_exprs = []
+    params = []
+    values = []
+    for expr in exprs:
+        expr = sp.sympify(expr)
+        replacements = {}
+        for const in sorted(expr.atoms(sp.Float), key=sp.default_sort_key):
+            symbol = sp.Symbol(f"c{len(params)}")
+            replacements[const] = symbol
+            params.append(symbol)
+            values.append(float(const))
+        param_exprs.append(expr.xreplace(replacements))
+    return param_exprs, params, np.array(values)
+
+
+def make_system(species: list[sp.Symbol], param_exprs: list,
+                params: list[sp.Symbol]):
+    """
+    Compile a parametrized ODE system into a single JAX function.
+
+    Args:
+        species: sympy symbols of the reactant quantities
+        param_exprs: d[species]/dt expressions, as returned by
+                     parametrize_constants
+        params: symbols of the constants
+    Returns:
+        f: callable f(X, c) returning the 1d array of derivatives
+    """
+    eqs = [
+        sp.lambdify([list(species), list(params)], expr, modules="jax")
+        for expr in param_exprs
+    ]
+
+    def f(X, c):
+        # constant expressions lambdify to scalars, broadcast them to X
+        return jnp.stack([jnp.zeros_like(X[0]) + eq(X, c) for eq in eqs])
+
+    return f
+
+
+def shooting_segments(qty_data: list[np.ndarray], times_data: list[np.ndarray],
+                      segment_steps: int = 20, max_segments: int | None = 2000,
+                      rng: np.random.Generator | None = None
+                      ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cut the stored runs into equal length windows for multiple shooting.
+
+    Args:
+        qty_data: A collections of runs over the same network
+        times_data: The time stamps associated with each simulated run
+        segment_steps: Number of integration steps per window
+        max_segments: Windows are subsampled to this many, None keeps all
+        rng: Random number generator used for subsampling
+    Returns:
+        windows: 3d array [window, step, species] of observed quantities
+        dts: 2d array [window, step] of the step sizes
+    """
+    windows = []
+    dts = []
+    for qty, times in zip(qty_data, times_data):
+        for start in range(0, qty.shape[0] - segment_steps, segment_steps):
+            stop = start + segment_steps + 1
+            windows.append(qty[start:stop])
+            dts.append(np.diff(times[start:stop]))
+
+    if not windows:
+        raise ValueError(f"no run is longer than {segment_steps} steps")
+
+    windows = np.stack(windows)
+    dts = np.stack(dts)
+    if max_segments is not None and windows.shape[0] > max_segments:
+        if rng is None:
+            rng = np.random.default_rng()
+        keep = rng.choice(windows.shape[0], max_segments, replace=False)
+        windows = windows[keep]
+        dts = dts[keep]
+    return windows, dts
+
+
+def shooting_loss(f, windows: np.ndarray, dts: np.ndarray):
+    """
+    Build the multiple shooting loss: each window is integrated with explicit
+    Euler steps (as in simulate_differential_equation) from its first observed
+    state, and compared with the observations along the whole window.
+
+    Args:
+        f: callable f(X, c), as returned by make_system
+        windows: 3d array [window, step, species] of observed quantities
+        dts: 2d array [window, step] of the step sizes
+    Returns:
+        loss: callable loss(c) giving the mean squared error
+    """
+    windows = jnp.asarray(windows)
+    dts = jnp.asarray(dts)
+
+    def integrate(x0, window_dts, c):
+        def step(x, dt):
+            x = x + f(x, c) * dt
+            return x, x
+        _, path = jax.lax.scan(step, x0, window_dts)
+        return path
+
+    integrate_all = jax.vmap(integrate, in_axes=(0, 0, None))
+
+    def loss(c):
+        path = integrate_all(windows[:, 0], dts, c)
+        return jnp.mean((path - windows[:, 1:]) ** 2)
+
+    return loss
+
+
+def refine_system(species: list[sp.Symbol], exprs: list,
+                  qty_data: list[np.ndarray], times_data: list[np.ndarray],
+                  segment_steps: int = 20, max_segments: int | None = 2000,
+                  maxiter: int = 200, rng: np.random.Generator | None = None,
+                  ) -> RefinedSystem:
+    """
+    Jointly refine the constants of an ODE system with BFGS on the multiple
+    shooting loss over the stored runs.
+
+    Args:
+        species: sympy symbols of the reactant quantities
+        exprs: one d[species]/dt expression per species
+        qty_data: A collections of runs over the same network
+        times_data: The time stamps associated with each simulated run
+        segment_steps: Number of integration steps per shooting window
+        max_segments: Windows are subsampled to this many, None keeps all
+        maxiter: Maximum number of optimizer iterations
+        rng: Random number generator used for subsampling
+    Returns:
+        refined: The refined equations and losses
+    """
+    # rate constants need more precision than jax's float32 default, enabled
+    # only here so the rest of the program keeps jax's global settings
+    with _enable_x64(True):
+        param_exprs, params, values = parametrize_constants(exprs)
+        windows, dts = shooting_segments(
+            qty_data, times_data,
+            segment_steps=segment_steps,
+            max_segments=max_segments,
+            rng=rng,
+        )
+        loss = jax.jit(shooting_loss(make_system(species, param_exprs, params), windows, dts))
+
+        initial_loss = float(loss(jnp.asarray(values)))
+        if len(params) == 0:
+            return RefinedSystem(list(exprs), initial_loss, initial_loss)
+
+        # normalize so the optimizer's gradient tolerance is scale free
+        scale = initial_loss if initial_loss > 0 else 1.0
+        result = jax.scipy.optimize.minimize(
+            lambda c: loss(c) / scale,
+            jnp.asarray(values),
+            method="BFGS",
+            options={"maxiter": maxiter},
+        )
+        refined_values = np.asarray(result.x)
+        refined_loss = float(result.fun) * scale
+
+        # keep the original constants if the optimizer made things worse
+        if not np.isfinite(refined_loss) or refined_loss > initial_loss:
+            refined_values, refined_loss = values, initial_loss
+
+        subs = {param: float(value) for param, value in zip(params, refined_values)}
+        return RefinedSystem(
+            equations=[expr.xreplace(subs) for expr in param_exprs],
+            loss=refined_loss,
+            initial_loss=initial_loss,
+        )
+
+
+def hall_of_fame(model: "pysr.PySRRegressor", top_n: int = 3) -> list[list]:
+    """
+    Pull the best scoring equations for every target out of a fitted model.
+
+    Args:
+        model: fitted regressor model, as returned by regressor_fit
+        top_n: Number of equations kept per target
+    Returns:
+        candidates: per target, a list of sympy expressions, best first
+    """
+    equations = model.equations_
+    if not isinstance(equations, list):
+        equations = [equations]
+    return [
+        list(eqs.sort_values("score", ascending=False)["sympy_format"][:top_n])
+        for eqs in equations
+    ]
+
+
+def refine_hall_of_fame(model: "pysr.PySRRegressor", qty_data: list[np.ndarray],
+                        times_data: list[np.ndarray], top_n: int = 3,
+                        **kwargs) -> list[RefinedSystem]:
+    """
+    Refine the best system found by the regressor, along with the systems made
+    by swapping in each runner-up equation for a single species.
+
+    Args:
+        model: fitted regressor model, as returned by regressor_fit
+        qty_data: A collections of runs over the same network
+        times_data: The time stamps associated with each simulated run
+        top_n: Number of hall of fame equations considered per species
+        kwargs: passed through to refine_system
+    Returns:
+        refined: The refined systems, lowest loss first
+    """
+    candidates = hall_of_fame(model, top_n=top_n)
+    species = sp.symbols(f"x0:{len(candidates)}")
+
+    best = [eqs[0] for eqs in candidates]
+    systems = [best]
+    for idx, eqs in enumerate(candidates):
+        for alternative in eqs[1:]:
+            systems.append(best[:idx] + [alternative] + best[idx + 1:])
+
+    refined = [
+        refine_system(species, system, qty_data, times_data, **kwargs)
+        for system in systems
+    ]
+    refined.sort(key=lambda system: system.loss)
+    return refined
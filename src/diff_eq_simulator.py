@@ -4,18 +4,42 @@ diff_eq_simulator.py
 Contains the code takes the differential equations for a system and generates
 time series data with some stochasticity.
 """
+from dataclasses import dataclass
+
 import numpy as np
 
 from .diff_eq_generator import create_callables
 
 
+# reasons a simulation run stopped
+STOP_COMPLETED = "completed"
+STOP_STEADY_STATE = "steady_state"
+STOP_DIVERGED = "diverged"
+STOP_NEGATIVE = "negative"
+
+
 def example_function():
     print(f"the example function in {__file__} is running")
 
 
+@dataclass
+class StopCriteria:
+    """
+    steady_state_tol (float or None): Stop once max |dx/dt| falls below this.
+    divergence_bound (float or None): Stop once the magnitude of any quantity
+        exceeds this. Runs that reach inf/NaN are always stopped.
+    stop_on_negative (bool): Stop once any quantity becomes negative.
+    """
+    steady_state_tol: float | None = None
+    divergence_bound: float | None = None
+    stop_on_negative: bool = False
+
+
 def simulate_network(rnet: "ReactionNetwork", x0: np.ndarray, t0: float,
                      tf:float, noise_intensity: np.ndarray | None=None,
-                     num_steps: int=1000) -> tuple[np.ndarray, np.ndarray]:
+                     num_steps: int=1000, dtype: type=np.float64,
+                     stop_criteria: StopCriteria | None=None,
+                     ) -> tuple[np.ndarray, np.ndarray, str]:
     """
     Simulate the reaction network, produce time series data of the quantity of
     the reactants.
@@ -28,37 +52,40 @@ def simulate_network(rnet: "ReactionNetwork", x0: np.ndarray, t0: float,
         tf: End time
         noise_intensity: Strength of the stochastic noise for each qty
         num_steps: Number of simulation steps
+        dtype: Floating point type of the produced arrays
+        stop_criteria: Conditions that end the run before num_steps
 
     Returns:
         reactants : 2d array of the reactant quantities at each time step.
         time: Array of time points
+        stop_reason: One of the STOP_* constants
     """
     eqs = create_callables(
         species=rnet.species,
         odes=rnet.odes,
     ) 
 
-    times = np.array([])
-
     def temp_func(X, t):
-        return np.array([eq(*X) for eq in eqs])
+        return np.array([eq(*X) for eq in eqs], dtype=X.dtype)
 
-    result, times = simulate_differential_equation(
+    return simulate_differential_equation(
         temp_func,
         x0=x0,
         t0=t0,
         tf=tf,
         noise_intensity=noise_intensity,
-        num_steps=num_steps
+        num_steps=num_steps,
+        dtype=dtype,
+        stop_criteria=stop_criteria,
     )
 
-    return result, times
-
 
 def simulate_differential_equation(f, x0: np.ndarray, t0: float, tf:float,
                                     noise_intensity: np.ndarray | None=None,
-                                    num_steps: int=1000
-                                    ) -> tuple[np.ndarray, np.ndarray]:
+                                    num_steps: int=1000,
+                                    dtype: type=np.float64,
+                                    stop_criteria: StopCriteria | None=None,
+                                    ) -> tuple[np.ndarray, np.ndarray, str]:
     """
     Simulate a system of differential equations with stochasticity.
     
@@ -69,10 +96,16 @@ def simulate_differential_equation(f, x0: np.ndarray, t0: float, tf:float,
         tf: End time
         noise_intensity: Strength of the stochastic noise for each qty
         num_steps: Number of simulation steps
+        dtype: Floating point type of the state array. np.float32 halves the
+               memory footprint at the cost of accuracy. Times stay float64,
+               float32 times would round the step sizes the derivatives need.
+        stop_criteria: Conditions that end the run before num_steps. The
+                       returned arrays are truncated to the last valid step.
 
     Returns:
         x: Array of reactant quantities over time
         time: Array of time points
+        stop_reason: One of the STOP_* constants
     """
     # Initialize time and state arrays
     state_size = x0.shape[0]
@@ -83,21 +116,45 @@ def simulate_differential_equation(f, x0: np.ndarray, t0: float, tf:float,
             has_noise = True
 
     time = np.linspace(t0, tf, num_steps)
-    x = np.zeros((num_steps, len(x0)))
+    x = np.zeros((num_steps, len(x0)), dtype=dtype)
     x[0] = x0
 
     dt = time[1] - time[0]
 
+    criteria = stop_criteria if stop_criteria is not None else StopCriteria()
+    stop_reason = STOP_COMPLETED
+    stop_idx = num_steps
+
     for i in range(1, num_steps):
         # Compute deterministic part (dx/dt = f(x,t))
-        dx = f(x[i-1], time[i-1]) * dt
+        drv = f(x[i-1], time[i-1])
+        if (criteria.steady_state_tol is not None
+                and np.max(np.abs(drv)) < criteria.steady_state_tol):
+            stop_reason, stop_idx = STOP_STEADY_STATE, i
+            break
+        dx = drv * dt
 
         # Add stochasticity (Gaussian noise if white noise is selected)
         if has_noise:
-            noise = np.random.normal(size=state_size) * noise_intensity
+            noise = (np.random.normal(size=state_size) * noise_intensity).astype(dtype)
             dx += noise
 
         # Update the state with the deterministic and stochastic parts
         x[i] = x[i-1] + dx
 
-    return x, time
+        # Drop the offending step, keep everything before it
+        if not np.all(np.isfinite(x[i])) or (
+                criteria.divergence_bound is not None
+                and np.max(np.abs(x[i])) > criteria.divergence_bound):
+            stop_reason, stop_idx = STOP_DIVERGED, i
+            break
+        if criteria.stop_on_negative and np.any(x[i] < 0):
+            stop_reason, stop_idx = STOP_NEGATIVE, i
+            break
+
+    if stop_idx < num_steps:
+        # copy so the unused tail of the buffers can be released
+        x = x[:stop_idx].copy()
+        time = time[:stop_idx].copy()
+
+    return x, time, stop_reason
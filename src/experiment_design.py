@@ -0,0 +1,181 @@
+"""
+experiment_design.py
+
+Tools for choosing the initial conditions of simulated runs so that the runs
+cover the state space evenly, or focus on where the current fit is poor.
+"""
+import numpy as np
+from scipy.stats import qmc
+
+
+# supported designs
+DESIGN_RANDOM = "random"
+DESIGN_LHS = "lhs"
+DESIGN_SOBOL = "sobol"
+DESIGN_HALTON = "halton"
+DESIGN_MAXMIN = "maxmin"
+DESIGN_ADAPTIVE = "adaptive"
+
+DESIGNS = [
+    DESIGN_RANDOM,
+    DESIGN_LHS,
+    DESIGN_SOBOL,
+    DESIGN_HALTON,
+    DESIGN_MAXMIN,
+    DESIGN_ADAPTIVE,
+]
+
+
+def example_function():
+    print(f"the example function in {__file__} is running")
+
+
+def sobol(runs: int, dims: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Scrambled Sobol sequence over the unit cube.
+
+    Args:
+        runs: Number of points
+        dims: Number of dimensions
+        rng: Random number generator
+    Returns:
+        points: 2d array [run, dim] of values in [0, 1)
+    """
+    # draw a power of two, which keeps the sequence balanced, and trim it
+    power = max(int(np.ceil(np.log2(runs))), 0)
+    return qmc.Sobol(dims, seed=rng).random_base2(power)[:runs]
+
+
+def maxmin(runs: int, dims: int, rng: np.random.Generator,
+           candidates_per_run: int = 20) -> np.ndarray:
+    """
+    Greedy max-min design: repeatedly take the random candidate furthest from
+    every point picked so far.
+
+    Args:
+        runs: Number of points
+        dims: Number of dimensions
+        rng: Random number generator
+        candidates_per_run: Size of the candidate pool per point
+    Returns:
+        points: 2d array [run, dim] of values in [0, 1)
+    """
+    candidates = rng.random((runs * candidates_per_run, dims))
+    min_dist = np.full(candidates.shape[0], np.inf)
+    picked = []
+    # start with the candidate nearest to the centre of the cube
+    pick = np.argmin(np.sum((candidates - 0.5) ** 2, axis=1))
+    for _ in range(runs):
+        picked.append(pick)
+        min_dist = np.minimum(
+            min_dist,
+            np.sum((candidates - candidates[pick]) ** 2, axis=1),
+        )
+        pick = np.argmax(min_dist)
+    return candidates[picked]
+
+
+def adaptive(runs: int, dims: int, rng: np.random.Generator,
+             residual_points: np.ndarray, residuals: np.ndarray,
+             candidates_per_run: int = 50, neighbors: int = 5,
+             max_reference_points: int = 2000) -> np.ndarray:
+    """
+    Place new points where the residuals of the current fit are largest,
+    while keeping the new points spread apart.
+
+    Args:
+        runs: Number of points
+        dims: Number of dimensions
+        rng: Random number generator
+        residual_points: 2d array [row, dim] of the fitted states, scaled to
+                         the unit cube
+        residuals: 1d array of the fit residual magnitude at each row
+        candidates_per_run: Size of the candidate pool per point
+        neighbors: Number of nearby rows averaged to estimate the residual at
+                   a candidate
+        max_reference_points: Rows are subsampled to this many to bound memory
+    Returns:
+        points: 2d array [run, dim] of values in [0, 1)
+    """
+    if residual_points.shape[0] > max_reference_points:
+        keep = rng.choice(residual_points.shape[0], max_reference_points,
+                          replace=False)
+        residual_points = residual_points[keep]
+        residuals = residuals[keep]
+
+    candidates = rng.random((runs * candidates_per_run, dims))
+
+    # estimate the residual at each candidate from its nearest fitted rows
+    dist = (
+        np.sum(candidates ** 2, axis=1)[:, np.newaxis]
+        + np.sum(residual_points ** 2, axis=1)[np.newaxis, :]
+        - 2 * candidates @ residual_points.T
+    )
+    k = min(neighbors, residual_points.shape[0])
+    nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    estimate = np.mean(residuals[nearest], axis=1)
+
+    # a perfect fit gives no residual to chase, spread the points instead
+    if not np.any(estimate > 0):
+        return maxmin(runs, dims, rng)
+
+    # damp candidates that crowd points that are already picked
+    spacing = runs ** (-1 / dims)
+    min_dist = np.full(candidates.shape[0], np.inf)
+    picked = []
+    for _ in range(runs):
+        score = estimate * np.minimum(1.0, np.sqrt(min_dist) / spacing)
+        pick = np.argmax(score)
+        picked.append(pick)
+        min_dist = np.minimum(
+            min_dist,
+            np.sum((candidates - candidates[pick]) ** 2, axis=1),
+        )
+    return candidates[picked]
+
+
+def initial_conditions(runs: int, ubound: np.ndarray, design: str = DESIGN_LHS,
+                       rng: np.random.Generator | None = None,
+                       residual_points: np.ndarray | None = None,
+                       residuals: np.ndarray | None = None) -> np.ndarray:
+    """
+    Pick initial conditions for a set of runs inside the box [0, ubound].
+
+    Args:
+        runs: Number of initial conditions
+        ubound: Upper bound of each reactant quantity
+        design: One of DESIGNS
+        rng: Random number generator, a fresh one is made if not provided
+        residual_points: Fitted reactant quantities, required for the
+                         adaptive design
+        residuals: Fit residual magnitude at each of residual_points, required
+                   for the adaptive design
+    Returns:
+        x0s: 2d array [run, reactant] of initial conditions
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    dims = ubound.shape[0]
+
+    if design == DESIGN_RANDOM:
+        unit = rng.random((runs, dims))
+    elif design == DESIGN_LHS:
+        unit = qmc.LatinHypercube(dims, seed=rng).random(runs)
+    elif design == DESIGN_SOBOL:
+        unit = sobol(runs, dims, rng)
+    elif design == DESIGN_HALTON:
+        unit = qmc.Halton(dims, seed=rng).random(runs)
+    elif design == DESIGN_MAXMIN:
+        unit = maxmin(runs, dims, rng)
+    elif design == DESIGN_ADAPTIVE:
+        if residual_points is None or residuals is None:
+            raise ValueError("the adaptive design needs residual_points and residuals")
+        unit = adaptive(
+            runs, dims, rng,
+            residual_points=residual_points / ubound,
+            residuals=residuals,
+        )
+    else:
+        raise ValueError(f"unknown design {design}, expected one of {DESIGNS}")
+
+    return ubound * unit
@@ -3,5 +3,327 @@ plot_tools.py
 
 Tools for plotting time series data.
 """
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import LineCollection
+
+from .utils import load_simulation_dir
+
+
+# Collections with more lines than this are rasterized by default
+RASTERIZE_THRESHOLD = 100
+
+DOWNSAMPLE_MINMAX = "minmax"
+DOWNSAMPLE_LTTB = "lttb"
+
+# smallest point budgets each method can keep to
+MINMAX_MIN_POINTS = 4
+LTTB_MIN_POINTS = 3
+# the phase portrait splits its budget between two min/max reductions
+PHASE_PORTRAIT_MIN_POINTS = 2 * MINMAX_MIN_POINTS
+
+
 def example_function():
     print(f"the example function in {__file__} is running")
+
+
+def downsample_minmax(y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Pick the indices of the smallest and largest value in evenly sized bins.
+    Peaks survive the reduction, which makes this a good fit for noisy data.
+
+    Args:
+        y: 1d array to be reduced.
+        max_points: Upper bound on the number of indices returned, at least
+                    MINMAX_MIN_POINTS
+    Returns:
+        indices: Sorted 1d array of the indices to keep.
+    """
+    if max_points < MINMAX_MIN_POINTS:
+        raise ValueError(
+            f"min/max downsampling needs max_points >= {MINMAX_MIN_POINTS}, got {max_points}"
+        )
+    num_points = y.shape[0]
+    if num_points <= max_points:
+        return np.arange(num_points)
+
+    # two points per bin, first and last points are always kept
+    num_bins = max((max_points - 2) // 2, 1)
+    bin_size = -(-num_points // num_bins)
+    num_bins = -(-num_points // bin_size)
+
+    padded = np.pad(y, (0, num_bins * bin_size - num_points), mode="edge")
+    binned = padded.reshape(num_bins, bin_size)
+    offsets = np.arange(num_bins) * bin_size
+
+    indices = np.concatenate([
+        [0],
+        offsets + np.argmin(binned, axis=1),
+        offsets + np.argmax(binned, axis=1),
+        [num_points - 1],
+    ])
+    return np.unique(np.minimum(indices, num_points - 1))
+
+
+def downsample_lttb(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling. Keeps the point in each bucket
+    that forms the largest triangle with its neighbours, which preserves the
+    visual shape of smooth curves better than min/max binning. Buckets are
+    visited in turn, so pass many equal length series at once as 2d arrays to
+    share that loop; a series at a time it is much slower than min/max.
+
+    Args:
+        x: Horizontal coordinates, e.g. time, 1d or [series, point]
+        y: Vertical coordinates, 1d or [series, point]
+        max_points: Number of indices returned per series, at least
+                    LTTB_MIN_POINTS
+    Returns:
+        indices: Sorted indices to keep, 1d or [series, index] matching y
+    """
+    if max_points < LTTB_MIN_POINTS:
+        raise ValueError(
+            f"LTTB downsampling needs max_points >= {LTTB_MIN_POINTS}, got {max_points}"
+        )
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    x = np.broadcast_to(np.atleast_2d(x), y.shape)
+    num_series, num_points = y.shape
+    if num_points <= max_points:
+        indices = np.broadcast_to(np.arange(num_points), y.shape)
+        return indices[0] if single else indices
+
+    edges = np.linspace(1, num_points - 1, max_points - 1).astype(int)
+    indices = np.zeros((num_series, max_points), dtype=int)
+    indices[:, -1] = num_points - 1
+    series = np.arange(num_series)
+
+    for bucket in range(max_points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        # average of the next bucket (the last point for the final bucket)
+        next_start = stop
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else num_points
+        avg_x = np.mean(x[:, next_start:next_stop], axis=1, keepdims=True)
+        avg_y = np.mean(y[:, next_start:next_stop], axis=1, keepdims=True)
+
+        prev = indices[:, bucket]
+        prev_x = x[series, prev][:, np.newaxis]
+        prev_y = y[series, prev][:, np.newaxis]
+        areas = np.abs(
+            (prev_x - avg_x) * (y[:, start:stop] - prev_y)
+            - (prev_x - x[:, start:stop]) * (avg_y - prev_y)
+        )
+        indices[:, bucket + 1] = start + np.argmax(areas, axis=1)
+
+    return indices[0] if single else indices
+
+
+def downsample(x: np.ndarray, y: np.ndarray, max_points: int | None = 1000,
+               method: str = DOWNSAMPLE_MINMAX) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce a series to at most max_points points for plotting.
+
+    Args:
+        x: 1d array of the horizontal coordinates.
+        y: 1d array of the vertical coordinates.
+        max_points: Upper bound on the number of points, None disables it.
+        method: DOWNSAMPLE_MINMAX or DOWNSAMPLE_LTTB
+    Returns:
+        x: The reduced horizontal coordinates
+        y: The reduced vertical coordinates
+    """
+    if max_points is None:
+        return x, y
+    if method == DOWNSAMPLE_MINMAX:
+        indices = downsample_minmax(y, max_points)
+    elif method == DOWNSAMPLE_LTTB:
+        indices = downsample_lttb(x, y, max_points)
+    else:
+        raise ValueError(f"unknown downsampling method {method}")
+    return x[indices], y[indices]
+
+
+def _add_lines(ax: "plt.Axes", segments: list[np.ndarray],
+               rasterized: bool | None, **kwargs) -> LineCollection:
+    """
+    Draw all segments with a single artist.
+    """
+    if rasterized is None:
+        rasterized = len(segments) > RASTERIZE_THRESHOLD
+    collection = LineCollection(segments, rasterized=rasterized, **kwargs)
+    ax.add_collection(collection)
+    ax.autoscale_view()
+    return collection
+
+
+def plot_trajectories(ax: "plt.Axes", qty_data: list[np.ndarray],
+                      times_data: list[np.ndarray], species: list[int] | None = None,
+                      max_points: int | None = 1000,
+                      method: str = DOWNSAMPLE_MINMAX,
+                      rasterized: bool | None = None,
+                      alpha: float = 0.5, linewidth: float = 0.75,
+                      ) -> list[LineCollection]:
+    """
+    Plot the quantity of each species over time for a set of runs. Every
+    species is drawn as one LineCollection, so thousands of runs stay cheap.
+
+    Args:
+        ax: Axes to draw on.
+        qty_data: A collection of runs over the same network
+        times_data: The time stamps associated with each run
+        species: Indices of the species to draw, defaults to all of them
+        max_points: Per-run point budget, None disables downsampling
+        method: DOWNSAMPLE_MINMAX (fastest) or DOWNSAMPLE_LTTB
+        rasterized: Rasterize the lines, defaults to True for large ensembles
+    Returns:
+        collections: One LineCollection per species
+    """
+    if species is None:
+        species = list(range(qty_data[0].shape[1]))
+
+    # LTTB shares its bucket loop across runs of equal length
+    length_groups = {}
+    for run_id, qty in enumerate(qty_data):
+        length_groups.setdefault(qty.shape[0], []).append(run_id)
+
+    collections = []
+    for color_idx, spec_id in enumerate(species):
+        segments = [None] * len(qty_data)
+        if method == DOWNSAMPLE_LTTB and max_points is not None:
+            for run_ids in length_groups.values():
+                x = np.stack([times_data[run_id] for run_id in run_ids])
+                y = np.stack([qty_data[run_id][:, spec_id] for run_id in run_ids])
+                indices = downsample_lttb(x, y, max_points)
+                x = np.take_along_axis(x, indices, axis=1)
+                y = np.take_along_axis(y, indices, axis=1)
+                for row, run_id in enumerate(run_ids):
+                    segments[run_id] = np.column_stack([x[row], y[row]])
+        else:
+            for run_id, (qty, times) in enumerate(zip(qty_data, times_data)):
+                x, y = downsample(times, qty[:, spec_id], max_points, method)
+                segments[run_id] = np.column_stack([x, y])
+        collections.append(_add_lines(
+            ax, segments, rasterized,
+            colors=f"C{color_idx}", alpha=alpha, linewidths=linewidth,
+            label=f"x{spec_id}",
+        ))
+
+    ax.set(xlabel="t", ylabel="n")
+    return collections
+
+
+def plot_phase_portrait(ax: "plt.Axes", qty_data: list[np.ndarray],
+                        x_idx: int = 0, y_idx: int = 1,
+                        max_points: int | None = 1000,
+                        rasterized: bool | None = None,
+                        alpha: float = 0.5, linewidth: float = 0.75,
+                        ) -> LineCollection:
+    """
+    Plot one species against another for a set of runs.
+
+    Args:
+        ax: Axes to draw on.
+        qty_data: A collection of runs over the same network
+        x_idx: Index of the species on the horizontal axis
+        y_idx: Index of the species on the vertical axis
+        max_points: Per-run point budget, at least PHASE_PORTRAIT_MIN_POINTS,
+                    None disables downsampling
+        rasterized: Rasterize the lines, defaults to True for large ensembles
+    Returns:
+        collection: LineCollection holding every run
+    """
+    if max_points is not None and max_points < PHASE_PORTRAIT_MIN_POINTS:
+        raise ValueError(
+            f"the phase portrait needs max_points >= {PHASE_PORTRAIT_MIN_POINTS}, "
+            f"got {max_points}"
+        )
+    segments = []
+    for qty in qty_data:
+        path = qty[:, [x_idx, y_idx]]
+        if max_points is not None:
+            # keep the extremes of both coordinates
+            indices = np.union1d(
+                downsample_minmax(path[:, 0], max_points // 2),
+                downsample_minmax(path[:, 1], max_points // 2),
+            )
+            path = path[indices]
+        segments.append(path)
+
+    collection = _add_lines(
+        ax, segments, rasterized, alpha=alpha, linewidths=linewidth,
+    )
+    ax.set(xlabel=f"x{x_idx}", ylabel=f"x{y_idx}")
+    return collection
+
+
+def plot_derivative_fit(ax: "plt.Axes", measured: np.ndarray,
+                        predicted: np.ndarray, max_points: int | None = 5000,
+                        rasterized: bool = True) -> None:
+    """
+    Scatter the fitted derivative against the measured derivative. A perfect
+    fit lies on the dashed diagonal.
+
+    Args:
+        ax: Axes to draw on.
+        measured: 1d array of the derivatives found from the data
+        predicted: 1d array of the derivatives given by the fitted equation
+        max_points: Point budget, None disables downsampling
+        rasterized: Rasterize the points
+    """
+    if max_points is not None and measured.shape[0] > max_points:
+        indices = np.linspace(0, measured.shape[0] - 1, max_points).astype(int)
+        measured = measured[indices]
+        predicted = predicted[indices]
+
+    ax.scatter(measured, predicted, s=2, alpha=0.5, rasterized=rasterized)
+    lims = [
+        min(np.min(measured), np.min(predicted)),
+        max(np.max(measured), np.max(predicted)),
+    ]
+    ax.plot(lims, lims, color="k", linestyle="--", linewidth=0.75)
+    ax.set(xlabel="measured dx/dt", ylabel="fitted dx/dt")
+
+
+def plot_simulation_dir(sim_dir: str, output_file: str | None = None,
+                        max_points: int | None = 1000,
+                        method: str = DOWNSAMPLE_MINMAX,
+                        rasterized: bool | None = None) -> "plt.Figure":
+    """
+    Plot the trajectories and phase portrait of a saved simulation dataset.
+
+    Args:
+        sim_dir: Directory holding the saved simulation runs.
+        output_file: Save the figure here if provided
+        max_points: Per-run point budget, None disables downsampling
+        method: DOWNSAMPLE_MINMAX or DOWNSAMPLE_LTTB
+        rasterized: Rasterize the lines, defaults to True for large ensembles
+    Returns:
+        fig: The created figure
+    """
+    qty_data, times_data, _ = load_simulation_dir(sim_dir)
+    if not qty_data:
+        raise ValueError(f"no simulation runs found in {sim_dir}")
+
+    num_species = qty_data[0].shape[1]
+    fig = plt.figure(layout="constrained")
+    fig.set_size_inches(12, 5)
+    axes = fig.subplots(1, 2 if num_species > 1 else 1, squeeze=False)[0]
+
+    plot_trajectories(
+        axes[0], qty_data, times_data,
+        max_points=max_points, method=method, rasterized=rasterized,
+    )
+    axes[0].set(title=f"Qty. vs Time, {len(qty_data)} runs")
+    axes[0].legend()
+
+    if num_species > 1:
+        plot_phase_portrait(
+            axes[1], qty_data,
+            max_points=max_points, rasterized=rasterized,
+        )
+        axes[1].set(title="Phase diagram")
+
+    if output_file is not None:
+        fig.savefig(output_file)
+
+    return fig
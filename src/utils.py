@@ -4,9 +4,155 @@ utils.py
 A collection of misc. tools.
 """
 
+import glob
+import logging
+from pathlib import Path
+
 import numpy as np
 
 
+# simulation dataset file suffixes
+REACTANTS_SUFFIX = "_reactants"
+TIMES_SUFFIX = "_times"
+STOP_SUFFIX = "_stop"
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+PRECISION_DTYPES = {
+    32: np.float32,
+    64: np.float64,
+}
+
+
+def precision_dtype(precision: int) -> type:
+    """
+    Look up the numpy floating point type for a bit precision.
+
+    Args:
+        precision: Number of bits, either 32 or 64.
+    Returns:
+        dtype: The matching numpy floating point type.
+    """
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(
+            f"unsupported precision {precision}, "
+            f"expected one of {list(PRECISION_DTYPES)}"
+        )
+    return PRECISION_DTYPES[precision]
+
+
+def precision_error(reference: np.ndarray, reduced: np.ndarray) -> float:
+    """
+    Report the accuracy lost by running a computation at reduced precision.
+
+    Args:
+        reference: Array produced at full precision.
+        reduced: The same array produced at reduced precision.
+    Returns:
+        error: Largest absolute difference, relative to the largest magnitude
+               in the reference.
+    """
+    scale = np.max(np.abs(reference))
+    if scale == 0:
+        scale = 1.0
+    return float(
+        np.max(np.abs(reference - reduced.astype(reference.dtype))) / scale
+    )
+
+
+def _run_ids(sim_dir: str, suffix: str) -> set[str]:
+    """
+    Collect the run ids (the filename prefix) of the files with a suffix.
+    """
+    filenames = glob.glob(
+        f"*{suffix}.npy",
+        dir_fd=sim_dir,
+    )
+    return {filename[:-len(f"{suffix}.npy")] for filename in filenames}
+
+
+def _run_sort_key(run_id: str) -> tuple:
+    return (0, int(run_id), "") if run_id.isdigit() else (1, 0, run_id)
+
+
+def list_simulation_runs(sim_dir: str, require_stop: bool = False) -> list[str]:
+    """
+    List the runs of a saved simulation that have both reactants and times.
+
+    Args:
+        sim_dir: Directory holding the saved simulation runs.
+        require_stop: Only list runs whose stop file exists. The stop file is
+                      written last, so this skips runs still being saved.
+    Returns:
+        run_ids: The filename prefix of each run, in run order
+    """
+    run_ids = _run_ids(sim_dir, REACTANTS_SUFFIX) & _run_ids(sim_dir, TIMES_SUFFIX)
+    if require_stop:
+        run_ids &= _run_ids(sim_dir, STOP_SUFFIX)
+    return sorted(run_ids, key=_run_sort_key)
+
+
+def load_simulation_runs(sim_dir: str, run_ids: list[str]
+                         ) -> tuple[list[np.ndarray], list[np.ndarray], list[str | None]]:
+    """
+    Load selected runs saved by the simulate subcommand.
+
+    Args:
+        sim_dir: Directory holding the saved simulation runs.
+        run_ids: Runs to load, as returned by list_simulation_runs
+    Returns:
+        reactants_arrays: a list of the reactant quantites over time for each run
+        times_arrays: a list of the timestamps for each run
+        stop_reasons: a list of the reason each run stopped, None for runs
+                      without a stop file
+    """
+    reactants_arrays = []
+    times_arrays = []
+    stop_reasons = []
+
+    for run_id in run_ids:
+        reactants_path = Path(Path(sim_dir), Path(f"{run_id}{REACTANTS_SUFFIX}.npy"))
+        logger.debug(f"loading: {reactants_path}")
+        reactants_arrays.append(np.load(reactants_path))
+        times_path = Path(Path(sim_dir), Path(f"{run_id}{TIMES_SUFFIX}.npy"))
+        logger.debug(f"loading: {times_path}")
+        times_arrays.append(np.load(times_path))
+        stop_path = Path(Path(sim_dir), Path(f"{run_id}{STOP_SUFFIX}.npy"))
+        stop_reason = None
+        if stop_path.exists():
+            logger.debug(f"loading: {stop_path}")
+            stop_reason = str(np.load(stop_path))
+        stop_reasons.append(stop_reason)
+
+    return reactants_arrays, times_arrays, stop_reasons
+
+
+def load_simulation_dir(sim_dir: str
+                        ) -> tuple[list[np.ndarray], list[np.ndarray], list[str | None] | None]:
+    """
+    Load the runs saved by the simulate subcommand.
+
+    Args:
+        sim_dir: Directory holding the saved simulation runs.
+    Returns:
+        reactants_arrays: a list of the reactant quantites over time for each run
+        times_arrays: a list of the timestamps for each run
+        stop_reasons: a list of the reason each run stopped, or None for
+                      datasets saved without stop files
+    """
+    run_ids = list_simulation_runs(sim_dir)
+    logger.debug(f"{run_ids}")
+    reactants_arrays, times_arrays, stop_reasons = load_simulation_runs(sim_dir, run_ids)
+
+    # datasets saved before stop files existed have none
+    if all(reason is None for reason in stop_reasons):
+        stop_reasons = None
+
+    return reactants_arrays, times_arrays, stop_reasons
+
+
 def derivative_finder_diff(reactants_data: np.ndarray, times_data: np.ndarray) -> np.ndarray:
     """
     Simple difference-based differentiator.
@@ -4,21 +4,93 @@ tests.py
 Confirm functionality of the program
 """
 
+import argparse
+import pickle
 from functools import partial
+from types import SimpleNamespace
 
+import jax.numpy as jnp
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import pytest
 import sympy as sp
 
+import main
 from src.diff_eq_generator import (
     ReactionNetwork,
     create_callables,
+    create_jacobian,
+    create_rate_sensitivity,
+    create_symbolic_jacobian,
     generate_reaction_network,
+    stoichiometry,
 )
 from src.diff_eq_simulator import (simulate_differential_equation,
-    simulate_network)
-from src.utils import lotka_volterra, derivative_finder_diff
+    simulate_network, StopCriteria, STOP_COMPLETED, STOP_STEADY_STATE,
+    STOP_DIVERGED, STOP_NEGATIVE)
+from src.utils import (lotka_volterra, derivative_finder_diff,
+    precision_dtype, precision_error, load_simulation_dir,
+    list_simulation_runs, load_simulation_runs)
+import src.diff_eq_recreator
+from src.diff_eq_recreator import (data_set_bundler, derivative_precision_error,
+    regressor_fit, FIT_COMPLETED, FIT_TIME_BUDGET, FIT_LOSS_TARGET, FIT_PLATEAU)
+from src.diff_eq_refiner import parametrize_constants, refine_system
+from src.experiment_design import (initial_conditions, DESIGNS,
+    DESIGN_RANDOM, DESIGN_LHS, DESIGN_SOBOL, DESIGN_MAXMIN, DESIGN_ADAPTIVE)
+from src.plot_tools import (downsample_minmax, downsample_lttb,
+    plot_derivative_fit, plot_simulation_dir)
+
+
+class FakeRegressor:
+    """
+    Stands in for pysr.PySRRegressor. Each fit moves on to the next scripted
+    best loss and advances the clock, if given, by seconds_per_fit.
+    """
+    def __init__(self, equations=None, losses=(0.1,), clock=None,
+                 seconds_per_fit=0.0, **params):
+        self.equations = [sp.Symbol("x0")] if equations is None else equations
+        self.losses = list(losses)
+        self.clock = clock
+        self.seconds_per_fit = seconds_per_fit
+        self.params = params
+        self.fits = []
+        self.equations_ = self.hall_of_fame(self.losses[0])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["params"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def hall_of_fame(self, losses):
+        # a scalar loss is shared by every target
+        losses = np.broadcast_to(losses, len(self.equations))
+        return [
+            pd.DataFrame({
+                "complexity": [3],
+                "loss": [loss],
+                "score": [1.0],
+                "equation": [str(eq)],
+                "sympy_format": [eq],
+            })
+            for eq, loss in zip(self.equations, losses)
+        ]
+
+    def get_best(self):
+        return [eqs.iloc[0] for eqs in self.equations_]
+
+    def set_params(self, **params):
+        self.params.update(params)
+        return self
+
+    def fit(self, X, y):
+        self.fits.append((X.shape[0], dict(self.params)))
+        self.equations_ = self.hall_of_fame(
+            self.losses[min(len(self.fits), len(self.losses)) - 1])
+        if self.clock is not None:
+            self.clock[0] += self.seconds_per_fit
+        return self
 
 
 class TestGenerator:
@@ -55,6 +127,61 @@ class TestGenerator:
             result = call_func(1,2,3)
             assert (result - target) < 0.2
 
+    def test_create_jacobian(self):
+        """
+        verify the mass-action Jacobian against symbolic differentiation
+        """
+        rnet = generate_reaction_network(
+            num_species=5,
+            num_reactions=6,
+            max_reactants=3,
+            seed=42,
+        )
+        jacobian = create_jacobian(rnet)
+        symbolic = create_symbolic_jacobian(rnet.species, rnet.odes)
+        X = np.random.default_rng(1).random((4, 5)) + 0.1
+
+        assert jacobian(X).shape == (4, 5, 5)
+        assert np.allclose(jacobian(X), symbolic(X))
+        assert np.allclose(jacobian(X[0], sparse=True).toarray(), jacobian(X[0]))
+        assert np.array_equal(
+            jacobian.sparsity().toarray() != 0,
+            symbolic.sparsity().toarray() != 0,
+        )
+
+        # species that take part in no reaction leave every entry zero
+        x0, x1 = sp.symbols("x0:2")
+        idle = ReactionNetwork(species=(x0, x1), odes=[0, 0], reactions=[])
+        for jacobian in (create_jacobian(idle),
+                         create_symbolic_jacobian(idle.species, idle.odes)):
+            assert np.array_equal(jacobian(np.ones((3, 2))), np.zeros((3, 2, 2)))
+            assert jacobian(np.ones(2), sparse=True).nnz == 0
+
+    def test_create_rate_sensitivity(self):
+        """
+        verify d f / d rate against finite differences of the rate constants
+        """
+        rnet = generate_reaction_network(
+            num_species=4,
+            num_reactions=5,
+            seed=3,
+        )
+        orders, net, rates = stoichiometry(rnet)
+
+        def f(x, k):
+            return net @ (k * np.prod(x ** orders, axis=1))
+
+        x = np.array([0.5, 1.2, 0.8, 2.0])
+        eps = 1e-6
+        finite_diff = np.stack([
+            (f(x, rates + eps * np.eye(len(rates))[idx]) - f(x, rates)) / eps
+            for idx in range(len(rates))
+        ], axis=1)
+
+        sensitivity = create_rate_sensitivity(rnet)
+        assert sensitivity(x).shape == (4, 5)
+        assert np.allclose(sensitivity(x), finite_diff, atol=1e-4)
+
 
 class TestSimulator:
     def test_simulate_network(self):
@@ -63,7 +190,7 @@ class TestSimulator:
             num_reactions=4,
             seed=42,
         )
-        reactants, times = simulate_network(
+        reactants, times, _ = simulate_network(
             rnet,
             x0=np.array([1.5, 3.8, 2.5]),
             t0=0,
@@ -86,7 +213,7 @@ class TestSimulator:
 
 
     def test_simulate_differential_equation(self):
-        species, times = simulate_differential_equation(
+        species, times, _ = simulate_differential_equation(
             lotka_volterra,
             x0=np.array([1.5,2.5]),
             t0=0,
@@ -109,9 +236,354 @@ class TestSimulator:
             axes[1].legend()
             plt.savefig('test_simulate_differential_equations.png')
 
+    def test_simulate_reduced_precision(self):
+        """
+        verify that float32 simulations stay close to the float64 reference
+        """
+        kwargs = dict(x0=np.array([1.5, 2.5]), t0=0, tf=10, num_steps=200)
+        species64, times64, _ = simulate_differential_equation(
+            lotka_volterra, dtype=np.float64, **kwargs)
+        species32, times32, _ = simulate_differential_equation(
+            lotka_volterra, dtype=np.float32, **kwargs)
+        assert species32.dtype == np.float32
+        assert times32.dtype == np.float64
+        error = precision_error(species64, species32)
+        print(f"float32 relative error: {error}")
+        assert error < 1e-4
+
+    def test_simulate_stop_criteria(self):
+        """
+        verify that runs stop early and are truncated
+        """
+        def decay(X, t):
+            return -X
+
+        def blow_up(X, t):
+            return X ** 2
+
+        def drain(X, t):
+            return -np.ones_like(X)
+
+        kwargs = dict(x0=np.array([1.0, 2.0]), t0=0, tf=20, num_steps=400)
+
+        species, times, reason = simulate_differential_equation(
+            decay, **kwargs)
+        assert reason == STOP_COMPLETED
+        assert species.shape == (400, 2)
+
+        species, times, reason = simulate_differential_equation(
+            decay, stop_criteria=StopCriteria(steady_state_tol=1e-3),
+            **kwargs)
+        assert reason == STOP_STEADY_STATE
+        assert species.shape[0] == times.shape[0] < 400
+
+        species, times, reason = simulate_differential_equation(
+            blow_up, stop_criteria=StopCriteria(divergence_bound=1e3),
+            **kwargs)
+        assert reason == STOP_DIVERGED
+        assert np.all(np.abs(species) <= 1e3)
+
+        species, times, reason = simulate_differential_equation(
+            drain, stop_criteria=StopCriteria(stop_on_negative=True),
+            **kwargs)
+        assert reason == STOP_NEGATIVE
+        assert np.all(species >= 0)
+
+        # inf/NaN stops a run even without a divergence bound
+        with np.errstate(over="ignore", invalid="ignore"):
+            species, times, reason = simulate_differential_equation(
+                blow_up, **kwargs)
+        assert reason == STOP_DIVERGED
+        assert np.all(np.isfinite(species))
+
 
 class TestRecreator:
-    pass
+    def test_data_set_bundler_reduced_precision(self):
+        """
+        verify the accuracy of float32 derivative targets at a realistic
+        step count, where differencing amplifies rounding
+        """
+        kwargs = dict(x0=np.array([1.5, 2.5]), t0=0, tf=8, num_steps=20000)
+        species64, times64, _ = simulate_differential_equation(
+            lotka_volterra, dtype=np.float64, **kwargs)
+        species32, times32, _ = simulate_differential_equation(
+            lotka_volterra, dtype=np.float32, **kwargs)
+
+        _, _, drv64 = data_set_bundler([species64], [times64])
+        _, _, drv32 = data_set_bundler([species32], [times32], dtype=np.float32)
+        assert drv32.dtype == np.float32
+        error = precision_error(drv64, drv32)
+        print(f"float32 derivative relative error: {error}")
+
+        # differencing in float32 throughout is much worse
+        naive = derivative_finder_diff(species32, times32.astype(np.float32))
+        assert error < precision_error(drv64, naive) / 4
+        assert error < 1e-3
+
+    def test_derivative_precision_error(self):
+        rnet = generate_reaction_network(
+            num_species=3,
+            num_reactions=4,
+            seed=14,
+        )
+        error = derivative_precision_error(rnet, np.float32, steps=5000)
+        print(f"float32 derivative relative error: {error}")
+        assert 0 < error < 1e-2
+        assert derivative_precision_error(rnet, np.float64, steps=500) == 0
+
+        # float32 overflows a few steps before float64, compare what both reached
+        x0 = sp.Symbol("x0")
+        blow_up = ReactionNetwork(species=(x0,), odes=[x0**2], reactions=[])
+        np.random.seed(0)
+        with np.errstate(over="ignore", invalid="ignore"):
+            error = derivative_precision_error(
+                blow_up, np.float32, ubound=np.array([5.0]), steps=50,
+                run_duration=3)
+        assert np.isfinite(error)
+
+    def test_regressor_fit_stop_reasons(self, monkeypatch):
+        """
+        verify that each stopping criterion ends the fit and is reported
+        """
+        clock = [0.0]
+        monkeypatch.setattr(src.diff_eq_recreator, "time",
+                            SimpleNamespace(monotonic=lambda: clock[0]))
+        rng = np.random.default_rng(0)
+        dataset, target = rng.random((50, 2)), rng.random((50, 2))
+
+        def fit(losses, seconds_per_fit=0.0, equations=None, **kwargs):
+            monkeypatch.setattr(
+                src.diff_eq_recreator.pysr, "PySRRegressor",
+                partial(FakeRegressor, equations=equations, losses=losses,
+                        clock=clock, seconds_per_fit=seconds_per_fit),
+            )
+            clock[0] = 0.0
+            return regressor_fit(dataset, target, **kwargs)
+
+        model, reason = fit([1.0], niterations=40)
+        assert reason == FIT_COMPLETED
+        assert [params["niterations"] for _, params in model.fits] == [40]
+
+        model, reason = fit(
+            [1.0, 0.5, 0.5, 0.4999, 0.5], niterations=1000,
+            plateau_iterations=20, check_every=10)
+        assert reason == FIT_PLATEAU
+        # improvements within plateau_rtol do not count
+        assert len(model.fits) == 4
+
+        # one target stuck while the other keeps improving is no plateau
+        x0, x1 = sp.symbols("x0:2")
+        model, reason = fit(
+            [(1.0, 0.5 ** fit_idx) for fit_idx in range(10)], equations=[x0, x1],
+            niterations=60, plateau_iterations=20, check_every=10)
+        assert reason == FIT_COMPLETED
+        assert len(model.fits) == 6
+        assert all(params["warm_start"] for _, params in model.fits)
+
+        model, reason = fit(
+            [1.0, 0.5, 1e-4], niterations=1000, loss_target=1e-3,
+            plateau_iterations=100)
+        assert reason == FIT_LOSS_TARGET
+        assert len(model.fits) == 3
+        assert model.fits[0][1]["early_stop_condition"] == 1e-3
+
+        model, reason = fit(
+            np.geomspace(1, 1e-3, 50), seconds_per_fit=30, niterations=1000,
+            time_budget=100, plateau_iterations=100)
+        assert reason == FIT_TIME_BUDGET
+        assert len(model.fits) == 4
+        # every chunk only gets the time left over
+        assert [params["timeout_in_seconds"] for _, params in model.fits] == [
+            100, 70, 40, 10]
+
+        # the plateau is not checked without plateau_iterations
+        model, reason = fit([1.0, 1.0], niterations=10, time_budget=100)
+        assert reason == FIT_COMPLETED
+        assert len(model.fits) == 1
+
+    def test_regressor_fit_warm_start(self, monkeypatch):
+        """
+        verify that a previous model is continued rather than rebuilt
+        """
+        def cold_start(**kwargs):
+            pytest.fail("a new regressor was made for a warm start")
+        monkeypatch.setattr(src.diff_eq_recreator.pysr, "PySRRegressor", cold_start)
+
+        previous = FakeRegressor(losses=[0.5], niterations=40, warm_start=False)
+        rng = np.random.default_rng(0)
+        model, reason = regressor_fit(
+            rng.random((50, 2)), rng.random((50, 2)), niterations=5, model=previous)
+        assert model is previous
+        assert reason == FIT_COMPLETED
+        assert model.fits[0][1]["warm_start"]
+        assert model.fits[0][1]["niterations"] == 5
+
+
+class TestRefiner:
+    def test_parametrize_constants(self):
+        x0, x1 = sp.symbols("x0:2")
+        exprs = [-1.5 * x0**2 * x1, 0.25 * x1 + 3]
+        param_exprs, params, values = parametrize_constants(exprs)
+        assert len(params) == 2
+        assert sorted(values) == [-1.5, 0.25]
+        for expr in param_exprs:
+            assert not expr.atoms(sp.Float)
+
+    def test_refine_system(self):
+        """
+        verify that perturbed rate constants are pulled back to the truth
+        """
+        rnet = generate_reaction_network(
+            num_species=3,
+            num_reactions=3,
+            seed=14,
+        )
+        rng = np.random.default_rng(0)
+        qty_data, times_data = [], []
+        for _ in range(4):
+            reactants, times, _ = simulate_network(
+                rnet, x0=rng.random(3), t0=0, tf=1, num_steps=200)
+            qty_data.append(reactants)
+            times_data.append(times)
+
+        true_odes = [sp.expand(ode) for ode in rnet.odes]
+        perturbed = [
+            ode.xreplace({c: sp.Float(1.2 * float(c)) for c in ode.atoms(sp.Float)})
+            for ode in true_odes
+        ]
+        refined = refine_system(rnet.species, perturbed, qty_data, times_data)
+        assert refined.loss < refined.initial_loss
+        # 64-bit mode stays scoped to the refinement
+        assert jnp.asarray(1.0).dtype == jnp.float32
+        for eq, ode in zip(refined.equations, true_odes):
+            assert sorted(float(c) for c in eq.atoms(sp.Float)) == pytest.approx(
+                sorted(float(c) for c in ode.atoms(sp.Float)), rel=1e-3)
+
+
+class TestExperimentDesign:
+    def test_initial_conditions(self):
+        """
+        verify that every design stays inside the ubound box
+        """
+        ubound = np.array([1.0, 2.0, 5.0])
+        rng = np.random.default_rng(3)
+        residual_points = ubound * rng.random((500, 3))
+        residuals = rng.random(500)
+        for design in DESIGNS:
+            x0s = initial_conditions(
+                20, ubound, design=design, rng=rng,
+                residual_points=residual_points, residuals=residuals,
+            )
+            assert x0s.shape == (20, 3)
+            assert np.all(x0s >= 0) and np.all(x0s <= ubound)
+
+        with pytest.raises(ValueError):
+            initial_conditions(20, ubound, design=DESIGN_ADAPTIVE)
+
+    def test_space_filling(self):
+        """
+        verify that the designs spread out better than independent draws
+        """
+        def min_spacing(points):
+            dist = np.linalg.norm(points[:, None] - points[None, :], axis=2)
+            return np.min(dist[np.triu_indices(len(points), 1)])
+
+        rng = np.random.default_rng(5)
+        ubound = np.ones(2)
+        for design in (DESIGN_LHS, DESIGN_SOBOL):
+            x0s = initial_conditions(16, ubound, design=design, rng=rng)
+            # one point in every stratum of every dimension
+            for dim in range(2):
+                assert sorted(np.floor(x0s[:, dim] * 16)) == list(range(16))
+
+        maxmin = initial_conditions(16, ubound, design=DESIGN_MAXMIN, rng=rng)
+        assert min_spacing(maxmin) > min_spacing(rng.random((16, 2)))
+
+    def test_adaptive(self):
+        """
+        verify that the adaptive design favours the high-residual region
+        """
+        rng = np.random.default_rng(7)
+        residual_points = rng.random((1000, 2))
+        residuals = (residual_points[:, 0] > 0.5).astype(float)
+        x0s = initial_conditions(
+            10, np.ones(2), design=DESIGN_ADAPTIVE, rng=rng,
+            residual_points=residual_points, residuals=residuals,
+        )
+        assert np.mean(x0s[:, 0] > 0.5) >= 0.8
+
+        # a perfect fit still spreads the new points out
+        x0s = initial_conditions(
+            5, np.ones(2), design=DESIGN_ADAPTIVE, rng=rng,
+            residual_points=residual_points, residuals=np.zeros(1000),
+        )
+        assert len(np.unique(x0s, axis=0)) == 5
+
+
+class TestPlotTools:
+    def test_downsample_minmax(self):
+        y = np.sin(np.linspace(0, 20, 20000))
+        y[1234] = 5.0
+        indices = downsample_minmax(y, 500)
+        assert len(indices) <= 500
+        assert np.all(np.diff(indices) > 0)
+        assert 1234 in indices
+        assert indices[0] == 0 and indices[-1] == len(y) - 1
+
+        # small budgets are kept too, or rejected
+        for max_points in range(4, 12):
+            assert len(downsample_minmax(y, max_points)) <= max_points
+        with pytest.raises(ValueError):
+            downsample_minmax(y, 3)
+
+    def test_downsample_lttb(self):
+        x = np.linspace(0, 20, 20000)
+        y = np.sin(x)
+        indices = downsample_lttb(x, y, 300)
+        assert len(indices) == 300
+        assert np.all(np.diff(indices) > 0)
+        assert np.max(y[indices]) > 0.99
+
+        # many series at once pick the same points as one at a time
+        ys = np.stack([y, np.cos(x), x ** 2])
+        batched = downsample_lttb(x, ys, 300)
+        assert batched.shape == (3, 300)
+        for row, series in enumerate(ys):
+            assert np.array_equal(batched[row], downsample_lttb(x, series, 300))
+
+        assert len(downsample_lttb(x, y, 3)) == 3
+        with pytest.raises(ValueError):
+            downsample_lttb(x, y, 2)
+
+    def test_plot_simulation_dir(self, tmp_path):
+        """
+        verify that a figure can be made from a saved dataset
+        """
+        for idx in range(5):
+            species, times, _ = simulate_differential_equation(
+                lotka_volterra,
+                x0=np.array([1.5, 2.5]) * (idx + 1) / 5,
+                t0=0,
+                tf=10,
+                num_steps=2000,
+            )
+            np.save(tmp_path / f"{idx}_reactants", species)
+            np.save(tmp_path / f"{idx}_times", times)
+
+        output_file = tmp_path / "runs.png"
+        fig = plot_simulation_dir(str(tmp_path), output_file=output_file,
+                                  max_points=200)
+        assert output_file.exists()
+        trajectories = fig.axes[0].collections
+        assert len(trajectories) == 2
+        assert len(trajectories[0].get_segments()) == 5
+        assert len(trajectories[0].get_segments()[0]) <= 200
+
+        fig, ax = plt.subplots()
+        plot_derivative_fit(ax, np.arange(10000.0), np.arange(10000.0),
+                            max_points=100)
+        assert len(ax.collections[0].get_offsets()) == 100
+        plt.close("all")
 
 
 class TestUtils:
@@ -123,4 +595,170 @@ class TestUtils:
         )
         assert np.all(np.abs(result - np.array([[0.5, 2.7/2]])) < 1e-5)
 
+    def test_precision_dtype(self):
+        assert precision_dtype(32) == np.float32
+        assert precision_dtype(64) == np.float64
+        with pytest.raises(ValueError):
+            precision_dtype(16)
+
+    def test_load_simulation_dir(self, tmp_path):
+        for idx in range(3):
+            np.save(tmp_path / f"{idx}_reactants", np.ones((4, 2)) * idx)
+            np.save(tmp_path / f"{idx}_times", np.arange(4.0))
+        reactants, times, stop_reasons = load_simulation_dir(str(tmp_path))
+        assert len(reactants) == len(times) == 3
+        assert reactants[2][0, 0] == 2
+        assert stop_reasons is None
+
+        np.save(tmp_path / "1_stop", np.array("completed"))
+        _, _, stop_reasons = load_simulation_dir(str(tmp_path))
+        assert stop_reasons == [None, "completed", None]
+
+    def test_list_simulation_runs(self, tmp_path):
+        for idx in [0, 2, 10]:
+            np.save(tmp_path / f"{idx}_reactants", np.ones((4, 2)))
+            np.save(tmp_path / f"{idx}_times", np.arange(4.0))
+        # a run that is still being saved
+        np.save(tmp_path / "11_reactants", np.ones((4, 2)))
+        np.save(tmp_path / "10_stop", np.array("completed"))
+
+        assert list_simulation_runs(str(tmp_path)) == ["0", "2", "10"]
+        assert list_simulation_runs(str(tmp_path), require_stop=True) == ["10"]
+        reactants, _, stop_reasons = load_simulation_runs(str(tmp_path), ["2", "10"])
+        assert len(reactants) == 2
+        assert stop_reasons == [None, "completed"]
+
+
+
+
+class TestMain:
+    def test_write_recreate_results_short_runs(self, tmp_path):
+        """
+        verify that refining runs shorter than a shooting window keeps the fit
+        """
+        x0, x1 = sp.symbols("x0:2")
+        model = FakeRegressor([-0.5 * x0, 0.5 * x0 - 0.25 * x1])
+        qty_data = [np.exp(-np.linspace(0, 1, 6))[:, np.newaxis] * np.ones(2)]
+        times_data = [np.linspace(0, 1, 6)]
+        args = argparse.Namespace(
+            residuals_file=None,
+            output=str(tmp_path / "out.txt"),
+            refine_top=1,
+            refine_segment_steps=20,
+        )
+        main.write_recreate_results(
+            args, model, "niterations", None, None, qty_data, times_data)
+        output = (tmp_path / "out.txt").read_text()
+        assert "fit stopped by: niterations" in output
+        assert "refined loss" in output
+
+        # nothing to refine against, the fit is still written
+        main.write_recreate_results(
+            args, model, "niterations", None, None,
+            [qty[:1] for qty in qty_data], [times[:1] for times in times_data])
+        output = (tmp_path / "out.txt").read_text()
+        assert "fit stopped by: niterations" in output
+        assert "refined loss" not in output
 
+    @pytest.mark.parametrize("stop_files", [True, False])
+    def test_recreate_follow(self, monkeypatch, tmp_path, stop_files):
+        """
+        verify that follow mode bundles finished runs as they arrive and warm
+        starts a single model across the increments, also for runs saved
+        without stop files
+        """
+        def save_run(idx, stop=True):
+            times = np.linspace(0, 1, 11)
+            np.save(tmp_path / f"{idx}_reactants", np.exp(-np.outer(times, [1, 2])))
+            np.save(tmp_path / f"{idx}_times", times)
+            if stop:
+                save_stop(idx)
+
+        def save_stop(idx):
+            np.save(tmp_path / f"{idx}_stop", np.array(STOP_COMPLETED))
+
+        if stop_files:
+            save_run(0)
+            save_run(1)
+            # still being simulated
+            save_run(2, stop=False)
+            batches = [lambda: (save_stop(2), save_run(3))]
+        else:
+            save_run(0, stop=False)
+            save_run(1, stop=False)
+            batches = [lambda: (save_run(2, stop=False), save_run(3, stop=False))]
+
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+            if batches:
+                batches.pop(0)()
+
+        monkeypatch.setattr(main, "time",
+                            SimpleNamespace(monotonic=lambda: clock[0], sleep=sleep))
+        models = []
+
+        def make_model(**params):
+            models.append(FakeRegressor(**params))
+            return models[-1]
+        monkeypatch.setattr(src.diff_eq_recreator.pysr, "PySRRegressor", make_model)
+
+        args = argparse.Namespace(
+            input_sim_dir=str(tmp_path),
+            follow=True,
+            poll_interval=2,
+            idle_timeout=5,
+            niterations=40,
+            increment_niterations=5,
+            maxsize=20,
+            precision=64,
+            time_budget=None,
+            loss_target=None,
+            plateau_iterations=None,
+            residuals_file=None,
+            refine_top=0,
+            refine_segment_steps=20,
+            output=str(tmp_path / "out.txt"),
+        )
+        main.recreate_runner(args)
+
+        assert len(models) == 1
+        (rows_first, params_first), (rows_second, params_second) = models[0].fits
+        assert rows_second == 2 * rows_first
+        assert params_first["niterations"] == 40
+        assert params_second["niterations"] == 5
+        assert params_second["warm_start"]
+        assert "increment 2: 4 runs" in (tmp_path / "out.txt").read_text()
+
+    def test_simulate_reduced_precision_diverging(self, tmp_path):
+        """
+        verify that float32 runs of a diverging network are all saved
+        """
+        x0 = sp.Symbol("x0")
+        network_file = tmp_path / "network.pkl"
+        with open(network_file, "wb") as out_file:
+            pickle.dump(
+                ReactionNetwork(species=(x0,), odes=[x0**2], reactions=[]),
+                out_file,
+            )
+        args = argparse.Namespace(
+            input_network_file=str(network_file),
+            output_dir=str(tmp_path / "sim"),
+            append=False,
+            ubound=5.0,
+            steps=50,
+            run_duration=3,
+            noise_intensity=0.0,
+            runs=3,
+            precision=32,
+            steady_state_tol=None,
+            divergence_bound=None,
+            stop_on_negative=False,
+            design=DESIGN_RANDOM,
+            residuals_file=None,
+        )
+        with np.errstate(over="ignore", invalid="ignore"):
+            main.simulate_runner(args)
+        _, _, stop_reasons = load_simulation_dir(args.output_dir)
+        assert stop_reasons == [STOP_DIVERGED] * 3